@@ -0,0 +1,492 @@
+"""Micro-benchmarks for the hot paths of painel.py.
+
+Run from anywhere; the panel is imported inside a temporary directory so the
+real *_db.json files are never touched:
+
+    python benchmark.py            # every benchmark
+    python benchmark.py lookup     # only the named ones
+"""
+import gzip
+import json
+import os
+import pickle
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="painel-bench-"))
+os.environ.setdefault("PAINEL_FLUSH_INTERVAL", "0")
+os.environ.setdefault("PAINEL_PROBE_INTERVAL", "0")
+
+import painel
+
+
+def timed(func, repeat: int) -> float:
+    """Average seconds per call of func over repeat calls."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def fill_clients(count: int):
+    painel.clients_db.clear()
+    for i in range(count):
+        painel.clients_db[str(uuid.uuid4())] = painel.Client(f"client{i}", f"pass{i}", 1, 4102358400, "active", f"reseller{i % 200}")
+    painel.index_clients()
+
+
+def scan_client_id(name: str):
+    """The linear scan get.php used before the name index."""
+    return next((cid for cid, client in painel.clients_db.items() if client.name == name), None)
+
+
+def bench_lookup():
+    """Credential lookup used by get.php, player_api.php and xmltv.php."""
+    print("clients     indexed lookup    linear scan (old)")
+    for count in (1_000, 10_000, 100_000, 1_000_000):
+        fill_clients(count)
+        names = [f"client{random.randrange(count)}" for _ in range(1000)]
+        it = iter(names * 100)
+        indexed = timed(lambda: painel.find_client_id(next(it)), 10_000)
+        it_scan = iter(names)
+        scan = timed(lambda: scan_client_id(next(it_scan)), max(5, 50_000 // count))
+        print(f"{count:>9,}   {indexed * 1e6:>10.2f} us   {scan * 1e3:>12.2f} ms")
+    painel.clients_db.clear()
+    painel.index_clients()
+
+
+def write_legacy_clients(path: str, count: int):
+    """clients_db.json as schema 1 wrote it: indent=4 and date strings."""
+    with open(path, "w") as f:
+        json.dump({str(uuid.uuid4()): {
+            "name": f"client{i}",
+            "password": f"pass{i}",
+            "connections": 1,
+            "expiry_date": "2099-12-31",
+            "status": "active",
+            "owner": f"reseller{i % 200}",
+        } for i in range(count)}, f, indent=4)
+
+
+def load_child(mode: str, directory: str):
+    """Runs in a fresh interpreter so the peak RSS only covers one loader."""
+    os.chdir(directory)
+    start = time.perf_counter()
+    if mode == "json.load":
+        with open(painel.CLIENTS_DB_FILE) as f:
+            data = json.load(f)
+    else:
+        data = painel.read_snapshot(painel.CLIENTS_DB_FILE)
+    elapsed = time.perf_counter() - start
+    # VmHWM rather than ru_maxrss, which a forked child inherits from its parent
+    with open("/proc/self/status") as f:
+        peak = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+    print(json.dumps({"records": len(data), "seconds": elapsed, "rss_mb": peak / 1024}))
+
+
+def bench_load():
+    """Startup load of clients_db.json: old json.load of dicts vs streaming Client records."""
+    print("clients     loader               time      peak RSS")
+    for count in (100_000, 1_000_000):
+        legacy = tempfile.mkdtemp(dir=".")
+        streamed = tempfile.mkdtemp(dir=".")
+        write_legacy_clients(os.path.join(legacy, painel.CLIENTS_DB_FILE), count)
+        os.chdir(legacy)
+        data = painel.read_snapshot(painel.CLIENTS_DB_FILE)
+        os.chdir("..")
+        painel.atomic_write(os.path.join(streamed, painel.CLIENTS_DB_FILE), painel.snapshot_lines(data))
+        del data
+        for mode, directory in (("json.load", legacy), ("streaming", streamed)):
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "_load_child", mode, os.path.abspath(directory)],
+                                 capture_output=True, text=True, check=True).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            print(f"{count:>9,}   {mode:<16} {result['seconds']:>8.2f} s   {result['rss_mb']:>8.0f} MB")
+        os.remove(os.path.join(legacy, painel.CLIENTS_DB_FILE))
+        os.remove(os.path.join(streamed, painel.CLIENTS_DB_FILE))
+
+
+def synthetic_playlist(count: int, shuffled: bool = False) -> bytes:
+    """An m3u_plus playlist shaped like the upstream one (live channels plus VOD).
+
+    shuffled puts the attributes in a different order per entry and adds the
+    extra ones (tvg-chno, catchup, tvg-rec) some providers send, some of them
+    unquoted (tvg-chno=5) or single-quoted (group-title='Grupo 3').
+    """
+    lines = ["#EXTM3U"]
+    for i in range(count):
+        attrs = [f'tvg-id="ch{i}.br"', f'tvg-name="Canal {i} HD"', f'tvg-logo="http://logos.example.com/{i}.png"', f'group-title="Grupo {i % 150}"']
+        if shuffled:
+            if i % 5 == 0:
+                attrs[3] = f"group-title='Grupo {i % 150}'"
+            attrs += [f'tvg-chno={i}', 'catchup="default"', "tvg-rec='3'"][:i % 4]
+            random.Random(i).shuffle(attrs)
+        lines.append(f'#EXTINF:-1 {" ".join(attrs)},Canal {i} HD')
+        lines.append(f"http://upstream.example.com:8080/live/492653/891525/{100000 + i}.ts")
+    return ("\n".join(lines) + "\n").encode()
+
+
+def serve_playlist(body: bytes, compress: bool = False, bytes_per_second: int = 0) -> ThreadingHTTPServer:
+    """Local stand-in for the upstream. compress gzips the body for clients
+    that accept it; bytes_per_second throttles it like a slow link."""
+    compressed = gzip.compress(body, 6) if compress else None
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            payload = body
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/x-mpegurl; charset=utf-8")
+            if compressed and "gzip" in self.headers.get("Accept-Encoding", ""):
+                payload = compressed
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            step = max(1, bytes_per_second // 20) if bytes_per_second else len(payload)
+            for offset in range(0, len(payload), step):
+                self.wfile.write(payload[offset:offset + step])
+                if bytes_per_second:
+                    time.sleep(step / bytes_per_second)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def buffered_fetch_m3u(url: str):
+    """fetch_m3u before streaming: response.text, then splitlines(), then the channels."""
+    response = painel.requests.get(url, timeout=30)
+    return list(painel.parse_m3u(response.text.splitlines()))
+
+
+def bench_ingest():
+    """Cache refresh: buffered response.text vs streamed iter_lines, peak Python heap and throughput."""
+    print("entries     fetcher         time      lines/s    peak heap")
+    for count in (10_000, 75_000, 250_000):
+        body = synthetic_playlist(count)
+        server = serve_playlist(body)
+        url = f"http://127.0.0.1:{server.server_address[1]}/get.php"
+        for label, fetch in (("buffered", buffered_fetch_m3u), ("streaming", painel.fetch_m3u)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            channels = fetch(url)
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            assert len(channels) == count
+            del channels
+            print(f"{count * 2:>9,}   {label:<12} {elapsed:>6.2f} s  {count * 2 / elapsed:>10,.0f}  {peak / 2**20:>8.1f} MB")
+        server.shutdown()
+
+
+def regex_parse_m3u(lines):
+    """parse_m3u before the tokenizer: a strict regex, then a fallback one, per line."""
+    channels = []
+    current_channel = {}
+    channel_index = 0
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#EXTM3U"):
+            continue
+        if line.startswith("#EXTINF:"):
+            match = re.search(r'tvg-id="([^"]*)"\s*tvg-name="([^"]*)"\s*tvg-logo="([^"]*)"\s*group-title="([^"]*)"\s*,(.+)', line)
+            if not match:
+                match = re.search(r'-1\s+(?:tvg-id="([^"]*)"\s*)?(?:tvg-name="([^"]*)"\s*)?(?:tvg-logo="([^"]*)"\s*)?(?:group-title="([^"]*)"\s*)?,(.+)', line)
+            if match:
+                tvg_id, name, logo, group, title = match.groups()
+                name = name or title or f"Channel_{channel_index}"
+                current_channel = {"tvg_id": tvg_id or name, "name": name.strip(), "logo": logo or "", "group": group or "Outros", "title": title.strip()}
+                channel_index += 1
+        elif line.startswith("http") and current_channel:
+            current_channel["url"] = line
+            channels.append(current_channel)
+            current_channel = {}
+    return channels
+
+
+def logo_and_group(channel):
+    """Works for the dicts regex_parse_m3u builds and for painel.Channel."""
+    return (channel["logo"], channel["group"]) if isinstance(channel, dict) else (channel.logo, channel.group)
+
+
+def tokenizer_parse_m3u(lines):
+    """parse_m3u the way fetch_m3u runs it, with the GC paused."""
+    with painel.gc_paused():
+        return list(painel.parse_m3u(lines))
+
+
+def bench_parser():
+    """EXTINF parsing: regex parser vs single-pass tokenizer, on fixed-order and shuffled attributes."""
+    print("entries     attributes   parser        lines/s    with logo+group")
+    for count in (10_000, 100_000, 500_000):
+        for shuffled in (False, True):
+            lines = synthetic_playlist(count, shuffled).decode().splitlines()
+            for label, parse in (("regex", regex_parse_m3u), ("tokenizer", tokenizer_parse_m3u)):
+                start = time.perf_counter()
+                channels = parse(lines)
+                elapsed = time.perf_counter() - start
+                complete = sum(1 for logo, group in map(logo_and_group, channels) if logo and group != "Outros")
+                print(f"{count:>9,}   {'shuffled' if shuffled else 'fixed':<12} {label:<10} {len(lines) / elapsed:>10,.0f}   {complete:>10,}")
+
+
+def bench_channels():
+    """Memory held by channels_cache["data"]: five-key dicts vs Channel records."""
+    print("channels    representation      heap        per channel")
+    for count in (10_000, 100_000, 500_000):
+        lines = synthetic_playlist(count).decode().splitlines()
+        for label, parse in (("dicts", regex_parse_m3u), ("Channel", lambda lines: list(painel.parse_m3u(lines)))):
+            tracemalloc.start()
+            channels = parse(lines)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(f"{count:>9,}   {label:<16} {size / 2**20:>7.1f} MB   {size / count:>8.0f} B")
+            del channels
+
+
+def bench_transfer():
+    """Refresh over a 50 Mbit/s link: identity vs gzip content encoding."""
+    print("entries     encoding     transferred   playlist     time")
+    for count in (10_000, 100_000):
+        body = synthetic_playlist(count)
+        for compress in (False, True):
+            server = serve_playlist(body, compress=compress, bytes_per_second=50_000_000 // 8)
+            transfer = {}
+            start = time.perf_counter()
+            channels = painel.fetch_m3u(f"http://127.0.0.1:{server.server_address[1]}/get.php", transfer=transfer)
+            elapsed = time.perf_counter() - start
+            server.shutdown()
+            assert len(channels) == count
+            print(f"{count:>9,}   {transfer['encoding']:<10} {transfer['transferred'] / 2**20:>9.2f} MB  {transfer['decoded'] / 2**20:>7.2f} MB  {elapsed:>6.2f} s")
+
+
+def serve_streams() -> ThreadingHTTPServer:
+    """Stand-in stream server: /ok/ answers HEAD, /nohead/ only a ranged GET
+    (405 to HEAD), /redirect/ a 302 and /dead/ a 404."""
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def reply(self, status: int):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_HEAD(self):
+            kind = self.path.split("/")[1]
+            self.reply({"ok": 200, "nohead": 405, "redirect": 302}.get(kind, 404))
+
+        def do_GET(self):
+            kind = self.path.split("/")[1]
+            self.reply({"ok": 206, "nohead": 206, "redirect": 302}.get(kind, 404))
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_probe():
+    """Stream prober against a local stand-in server: rounds until dead channels are hidden."""
+    server = serve_streams()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    kinds = ("ok", "nohead", "redirect", "dead")
+    for count in (1_000, 10_000):
+        lines = []
+        for i in range(count):
+            lines += [f'#EXTINF:-1 tvg-id="ch{i}",Canal {i}', f"{base}/{kinds[i % 4]}/{i}.ts"]
+        # A host with nothing listening: connection refused
+        lines += ['#EXTINF:-1 tvg-id="off",Offline', "http://127.0.0.1:9/live/1.ts"]
+        painel.channels_cache["data"] = list(painel.parse_m3u(lines))
+        painel.channels_cache["last_updated"] = painel.datetime.now()
+        painel.channel_health.clear()
+        for round_number in range(1, painel.PROBE_DEAD_AFTER + 1):
+            start = time.perf_counter()
+            painel.probe_channels()
+            elapsed = time.perf_counter() - start
+            print(f"{count + 1:>9,} streams  round {round_number}: {elapsed:>6.2f} s  {(count + 1) / elapsed:>8,.0f} probes/s  "
+                  f"{len(painel.live_channels()):>7,} served")
+        assert len(painel.live_channels()) == count - count // 4
+    server.shutdown()
+    painel.channels_cache["data"] = []
+    painel.channel_health.clear()
+    painel.dead_urls = frozenset()
+
+
+def concat_render(channels) -> str:
+    """get_m3u before pre-rendering: regroup and grow a str with += on every request."""
+    m3u_content = "#EXTM3U\n"
+    grouped_channels = {}
+    for channel in channels:
+        grouped_channels.setdefault(channel.group, []).append(channel)
+    for group, group_channels in grouped_channels.items():
+        for channel in group_channels:
+            extra = "".join(f' {key}="{value}"' for key, value in (channel.attrs or {}).items())
+            m3u_content += f'#EXTINF:-1 tvg-id="{channel.tvg_id}" tvg-name="{channel.name}" tvg-logo="{channel.logo}" group-title="{group}"{extra},{channel.title}\n'
+            m3u_content += f"{channel.url}\n"
+    return m3u_content
+
+
+def bench_playlist():
+    """get.php throughput: per-request rendering vs bytes rendered once per cache generation."""
+    painel.clients_db["bench"] = painel.Client("bench", "bench", 1, 4102358400, "active", "admin")
+    painel.index_clients(["bench"])
+    client = painel.app.test_client()
+    print("channels    per-request render    pre-rendered get.php")
+    for count in (1_000, 10_000, 100_000):
+        painel.channels_cache["data"] = list(painel.parse_m3u(synthetic_playlist(count, shuffled=True).decode().splitlines()))
+        painel.channels_cache["last_updated"] = painel.datetime.now()
+        painel.channels_cache["generation"] += 1
+        assert client.get("/get.php?username=bench&password=bench").data == concat_render(painel.channels_cache["data"]).encode()
+        old = timed(lambda: concat_render(painel.channels_cache["data"]), max(3, 20_000 // count))
+        new = timed(lambda: client.get("/get.php?username=bench&password=bench").data, 200)
+        print(f"{count:>9,}   {1 / old:>10,.1f} req/s     {1 / new:>10,.0f} req/s")
+    painel.channels_cache["data"] = []
+    del painel.clients_db["bench"]
+    painel.index_clients(["bench"])
+
+
+def bench_packages():
+    """Per-package get.php and get_live_streams: filtering and rendering per request vs per cache generation."""
+    painel.channels_cache["data"] = list(painel.parse_m3u(synthetic_playlist(100_000, shuffled=True).decode().splitlines()))
+    painel.channels_cache["last_updated"] = painel.datetime.now()
+    painel.channels_cache["generation"] += 1
+    client = painel.app.test_client()
+    print("100,000 channels in 150 groups")
+    print("groups    per-request get.php    pre-rendered get.php    per-request streams    pre-built streams")
+    for size in (10, 50, 150):
+        groups = [f"Grupo {i}" for i in range(size)]
+        # A new id per size: packages are never edited in place
+        painel.packages_db[f"bench-{size}"] = {"name": "bench", "groups": groups}
+        painel.clients_db["bench"] = painel.Client("bench", "bench", 1, 4102358400, "active", "admin", f"bench-{size}")
+        painel.index_clients(["bench"])
+        allowed = set(groups)
+
+        def per_request_playlist():
+            return concat_render([channel for channel in painel.channels_cache["data"] if channel.group in allowed])
+
+        def per_request_streams():
+            with painel.app.app_context():
+                return painel.jsonify([{"stream_id": channel.tvg_id, "name": channel.name, "logo": channel.logo, "epg_channel_id": channel.tvg_id,
+                                        "category_id": "1", "stream_type": "live", "stream_url": channel.url, "added": "0", "is_adult": 0}
+                                       for channel in painel.channels_cache["data"] if channel.group in allowed]).data
+
+        assert client.get("/get.php?username=bench&password=bench").data == per_request_playlist().encode()
+        playlist_old = timed(per_request_playlist, 5)
+        playlist_new = timed(lambda: client.get("/get.php?username=bench&password=bench").data, 200)
+        streams_old = timed(per_request_streams, 3)
+        streams_new = timed(lambda: client.get("/player_api.php?username=bench&password=bench&action=get_live_streams").data, 200)
+        print(f"{size:>6}   {1 / playlist_old:>12,.1f} req/s   {1 / playlist_new:>14,.0f} req/s   {1 / streams_old:>13,.1f} req/s   {1 / streams_new:>11,.0f} req/s")
+    painel.channels_cache["data"] = []
+    for size in (10, 50, 150):
+        del painel.packages_db[f"bench-{size}"]
+    del painel.clients_db["bench"]
+    painel.index_clients(["bench"])
+
+
+def bench_stream():
+    """Memory while 20 clients download a 100k-channel playlist at the same time, one write at a time."""
+    from werkzeug.test import EnvironBuilder
+    painel.clients_db["bench"] = painel.Client("bench", "bench", 1, 4102358400, "active", "admin")
+    painel.index_clients(["bench"])
+    painel.channels_cache["data"] = list(painel.parse_m3u(synthetic_playlist(100_000, shuffled=True).decode().splitlines()))
+    painel.channels_cache["last_updated"] = painel.datetime.now()
+    painel.channels_cache["generation"] += 1
+    size = len(painel.playlist_bytes())
+
+    def per_request_str(environ, start_response):
+        """get_m3u before pre-rendering: a fresh str per request, encoded by the Response."""
+        return painel.Response(concat_render(painel.channels_cache["data"]), mimetype="application/x-mpegURL")(environ, start_response)
+
+    print(f"playlist {size / 2**20:.1f} MB, 20 concurrent downloads")
+    print("mode                     peak heap    writes/download")
+    for label, app, streaming in (("rendered per request", per_request_str, False), ("shared bytes", painel.app, False), ("chunked stream", painel.app, True)):
+        painel.PLAYLIST_STREAMING = streaming
+        tracemalloc.start()
+        downloads = [iter(app(EnvironBuilder(path="/get.php", query_string="username=bench&password=bench").get_environ(), lambda *args: None))
+                     for _ in range(20)]
+        writes = 0
+        while downloads:
+            for download in list(downloads):
+                chunk = next(download, None)
+                if chunk is None:
+                    downloads.remove(download)
+                else:
+                    writes += 1
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{label:<22} {peak / 2**20:>8.1f} MB   {writes / 20:>10,.0f}")
+    painel.PLAYLIST_STREAMING = False
+    painel.channels_cache["data"] = []
+    del painel.clients_db["bench"]
+    painel.index_clients(["bench"])
+
+
+def bench_compression():
+    """Pre-compressed playlist variants: size and CPU per cache generation."""
+    print("channels    encoding     playlist    compressed   saved    CPU/refresh")
+    for count in (10_000, 100_000, 500_000):
+        content = painel.render_m3u(list(painel.parse_m3u(synthetic_playlist(count, shuffled=True).decode().splitlines())))
+        painel.compress_playlist({"encoded": {}}, "ts", content)
+        for encoding, stats in painel.compression_stats["encodings"].items():
+            print(f"{count:>9,}   {encoding:<8} {stats['identity_bytes'] / 2**20:>8.1f} MB  {stats['compressed_bytes'] / 2**20:>8.2f} MB"
+                  f"  {1 - stats['compressed_bytes'] / stats['identity_bytes']:>6.1%}  {stats['cpu_seconds']:>8.2f} s")
+
+
+def bench_snapshot():
+    """Warm start: reparsing the playlist vs pickled Channel objects vs the columnar channels snapshot."""
+    print("channels    source                load      file")
+    for count in (10_000, 100_000, 500_000):
+        body = synthetic_playlist(count, shuffled=True)
+        start = time.perf_counter()
+        channels = list(painel.parse_m3u(body.decode().splitlines()))
+        print(f"{count:>9,}   {'parse_m3u':<18} {time.perf_counter() - start:>7.3f} s   {len(body) / 2**20:>5.1f} MB")
+        objects = pickle.dumps(channels, pickle.HIGHEST_PROTOCOL)
+        start = time.perf_counter()
+        pickle.loads(objects)
+        print(f"{count:>9,}   {'pickled objects':<18} {time.perf_counter() - start:>7.3f} s   {len(objects) / 2**20:>5.1f} MB")
+        painel.channels_cache["sources"] = {"principal": {"validators": {}, "channels": channels}}
+        painel.write_channels_snapshot(channels, "bench")
+        start = time.perf_counter()
+        snapshot = painel.read_channels_snapshot()
+        elapsed = time.perf_counter() - start
+        assert [channel.url for channel in snapshot["channels"]] == [channel.url for channel in channels]
+        print(f"{count:>9,}   {'channels snapshot':<18} {elapsed:>7.3f} s   {os.path.getsize(painel.CHANNELS_SNAPSHOT_FILE) / 2**20:>5.1f} MB")
+        del channels, snapshot, objects
+    painel.channels_cache["sources"] = {}
+    os.remove(painel.CHANNELS_SNAPSHOT_FILE)
+
+
+BENCHMARKS = {
+    "lookup": bench_lookup,
+    "load": bench_load,
+    "ingest": bench_ingest,
+    "parser": bench_parser,
+    "channels": bench_channels,
+    "snapshot": bench_snapshot,
+    "transfer": bench_transfer,
+    "probe": bench_probe,
+    "playlist": bench_playlist,
+    "packages": bench_packages,
+    "stream": bench_stream,
+    "compression": bench_compression,
+}
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["_load_child"]:
+        load_child(sys.argv[2], sys.argv[3])
+        sys.exit()
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
+        print()
@@ -3,11 +3,46 @@ import requests
 import re
 import json
 import os
+import sys
+import threading
+import time
+import atexit
+import heapq
+import asyncio
+import ssl
+import gzip
+import hashlib
+import io
+import tempfile
+import click
+import sqlite3
 from datetime import datetime, timedelta
-from typing import List, Dict
+from urllib.parse import urlsplit
+from typing import List, Dict, Iterable, Optional, Tuple
+from collections.abc import MutableMapping
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+import pickle
+import gc
+import copy
+from array import array
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import uuid
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
+# "gzip,deflate" plus br/zstd when urllib3 can decode them (brotli/zstandard installed)
+from requests.packages.urllib3.util.request import ACCEPT_ENCODING
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24).hex()
@@ -19,55 +54,788 @@ PUBLIC_URL3 = "http://backup2.jontexplay.serveo.net"
 
 # Source M3U URL
 M3U_URL = "http://facilita.fun/get.php?username=492653&password=891525&type=m3u_plus&output=hls"
+# Upstream playlists fetched in parallel and merged; a lower priority wins when
+# two sources carry the same channel (same stream URL, or same tvg-id when the
+# entry has one), and a failed source is left out of the
+# merge so the others take over. Override with a JSON list in PAINEL_M3U_SOURCES,
+# e.g. [{"name": "principal", "url": "http://...", "priority": 0}, ...]
+M3U_SOURCES = json.loads(os.environ.get("PAINEL_M3U_SOURCES", "null")) or [{"name": "principal", "url": M3U_URL, "priority": 0}]
 
 # Database files
 USERS_DB_FILE = "users_db.json"
 CLIENTS_DB_FILE = "clients_db.json"
 RESELLERS_DB_FILE = "resellers_db.json"
 LAYOUT_SETTINGS_FILE = "layout_settings.json"
+PACKAGES_DB_FILE = "packages_db.json"
+
+# Storage backend: "json" (files + journal) or "sqlite" (one row per record,
+# shared safely by several gunicorn workers)
+STORAGE_BACKEND = os.environ.get("PAINEL_STORAGE", "json")
+SQLITE_DB_FILE = "painel.db"
+# Table and indexed columns for each store
+SQLITE_TABLES = {
+    USERS_DB_FILE: ("users", ()),
+    CLIENTS_DB_FILE: ("clients", ("name", "owner", "package")),
+    RESELLERS_DB_FILE: ("resellers", ("created_by", "package")),
+    LAYOUT_SETTINGS_FILE: ("layout_settings", ()),
+    PACKAGES_DB_FILE: ("packages", ()),
+}
 
 # Cache for M3U list
-channels_cache = {"data": [], "last_updated": None}
+channels_cache = {"data": [], "last_updated": None, "last_attempt": None, "last_outcome": None, "last_duration": None,
+                  "version": None, "sources": {}, "last_diff": None, "generation": 0}
+# Per-source timing and health
+source_stats = {source["name"]: {"priority": source.get("priority", 0), "channels": 0, "successes": 0, "failures": 0,
+                                 "last_outcome": None, "last_duration": None, "total_duration": 0.0, "last_success": None,
+                                 "transfer": {}}
+                for source in M3U_SOURCES}
 CACHE_TIMEOUT = timedelta(hours=1)
+# Wait this long after a failed refresh before asking the upstream again
+CACHE_RETRY_INTERVAL = timedelta(minutes=1)
+# Workers on one host take turns on this lock; the one that downloads leaves the
+# parsed list in the snapshot file for the others. The snapshot is also what
+# every worker serves from at startup while the first refresh runs.
+CHANNELS_LOCK_FILE = "channels_refresh.lock"
+CHANNELS_SNAPSHOT_FILE = "channels_cache.pickle"
+CHANNELS_SNAPSHOT_FORMAT = 2
+# Bytes read from the upstream playlist per network read
+M3U_CHUNK_SIZE = 64 * 1024
+# #EXTINF:<duration> key="value"...,<title>; the attributes may come in any
+# order. The header ends at the first comma outside quotes (one way to match
+# each character, so no backtracking blowup), and the attributes may be
+# key="v", key='v' or key=v; anything else in the header is skipped, never
+# the whole entry.
+EXTINF_RE = re.compile(r'#EXTINF:((?:[^,"\']|"[^"]*"|\'[^\']*\')*),(.*)')
+EXTINF_ATTRIBUTE_RE = re.compile(r'([\w-]+)=(?:"([^"]*)"|\'([^\']*)\'|([^\s"\',]*))')
+# Fast path for the usual tvg-id, tvg-name, tvg-logo, group-title order with
+# nothing else: one match and no attribute dict
+EXTINF_FIXED_RE = re.compile(r'#EXTINF:\s*-?[\d.]*\s+tvg-id="([^"]*)"\s*tvg-name="([^"]*)"\s*tvg-logo="([^"]*)"\s*group-title="([^"]*)"\s*,\s*(.*)')
+
+# Stream liveness prober: every PROBE_INTERVAL seconds (0, the default,
+# disables it) each channel URL gets a HEAD (or a 1-byte GET when HEAD is
+# refused); a channel whose last PROBE_DEAD_AFTER checks all failed is left out
+# of the playlists. Only the worker holding PROBE_LOCK_FILE probes; it writes
+# the dead URLs to DEAD_URLS_FILE, which the other workers on the host pick up,
+# so every worker hides the same channels and the upstream sees one prober.
+PROBE_INTERVAL = int(os.environ.get("PAINEL_PROBE_INTERVAL", "0"))
+PROBE_TIMEOUT = 5
+PROBE_CONCURRENCY = 50
+PROBE_PER_HOST = 4
+PROBE_DEAD_AFTER = 3
+PROBE_LOCK_FILE = "stream_prober.lock"
+DEAD_URLS_FILE = "dead_urls.json"
+# How often the other workers look for a new DEAD_URLS_FILE
+PROBE_FOLLOW_INTERVAL = 30
 
 # Maintenance mode
 MAINTENANCE_MODE = False
 
-def load_db(file_path: str, default: Dict = None) -> Dict:
+# Seconds between runs of the expiry scheduler
+EXPIRY_CHECK_INTERVAL = 60
+
+# Backups: full snapshots plus incrementals that only hold the records whose
+# content changed since the previous backup
+BACKUP_DIR = "backups"
+BACKUP_MANIFEST = os.path.join(BACKUP_DIR, "manifest.json")
+
+# Bumped whenever stored records change shape; older data is migrated once
+SCHEMA_VERSION = 2
+DB_META_FILE = "db_meta.json"
+
+class Client:
+    """Compact client record. Expiry is kept as epoch seconds (local midnight
+    of the expiry day) so the auth path never parses dates."""
+    __slots__ = ("name", "password", "connections", "expires_at", "status", "owner", "package")
+
+    def __init__(self, name: str, password: str, connections: int, expires_at: int, status: str, owner: str, package: Optional[str] = None):
+        self.name = name
+        self.password = password
+        self.connections = connections
+        self.expires_at = expires_at
+        self.status = sys.intern(status)
+        self.owner = sys.intern(owner)
+        self.package = package
+
+    @property
+    def expiry_date(self) -> str:
+        return datetime.fromtimestamp(self.expires_at).strftime("%Y-%m-%d")
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Client":
+        expires_at = data.get("expires_at")
+        if expires_at is None:
+            # Schema 1 stored the expiry as a "%Y-%m-%d" string
+            expires_at = date_to_epoch(data["expiry_date"])
+        return cls(data["name"], data["password"], data.get("connections", 1), expires_at, data.get("status", "active"), data.get("owner", "admin"),
+                   data.get("package"))
+
+    def to_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "password": self.password,
+            "connections": self.connections,
+            "expires_at": self.expires_at,
+            "status": self.status,
+            "owner": self.owner,
+            "package": self.package
+        }
+
+class Channel:
+    """Compact playlist entry. Group names are interned and the stream URL is
+    split so every channel of a server shares one scheme/host/credentials
+    prefix string."""
+    __slots__ = ("tvg_id", "name", "logo", "group", "title", "attrs", "url_prefix", "url_path")
+
+    def __init__(self, tvg_id: str, name: str, logo: str, group: str, title: str, url: str, attrs: Optional[Dict] = None):
+        # Without tvg-name/tvg-id the three fields hold the same text; keep one copy
+        self.title = title
+        self.name = title if name == title else name
+        self.tvg_id = self.name if tvg_id == name else tvg_id
+        self.logo = logo
+        self.group = sys.intern(group)
+        self.attrs = attrs or None
+        split = url.rfind("/") + 1
+        self.url_prefix = sys.intern(url[:split])
+        self.url_path = url[split:]
+
+    @property
+    def url(self) -> str:
+        return self.url_prefix + self.url_path
+
+    def signature(self) -> tuple:
+        return (self.tvg_id, self.name, self.logo, self.group, self.title, tuple(self.attrs.items()) if self.attrs else ())
+
+@contextmanager
+def gc_paused():
+    """Building hundreds of thousands of objects otherwise triggers a GC pass
+    every few hundred allocations."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def pack_channels(channels: List[Channel]) -> tuple:
+    """One list per Channel slot: pickles and loads at C speed, unlike a list of objects."""
+    return tuple([getattr(channel, field) for channel in channels] for field in Channel.__slots__)
+
+def unpack_channels(columns: tuple) -> List[Channel]:
+    channels = []
+    new = Channel.__new__
+    with gc_paused():
+        for tvg_id, name, logo, group, title, attrs, url_prefix, url_path in zip(*columns):
+            channel = new(Channel)
+            channel.tvg_id = tvg_id
+            channel.name = name
+            channel.logo = logo
+            channel.group = sys.intern(group)
+            channel.title = title
+            channel.attrs = attrs
+            channel.url_prefix = sys.intern(url_prefix)
+            channel.url_path = url_path
+            channels.append(channel)
+    return channels
+
+def date_to_epoch(date: str) -> int:
+    return int(datetime.strptime(date, "%Y-%m-%d").timestamp())
+
+def encode_record(value):
+    if isinstance(value, Client):
+        return value.to_dict()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+def decode_record(file_path: str, value):
+    return Client.from_dict(value) if file_path == CLIENTS_DB_FILE else value
+
+def record_field(value, field: str):
+    return value.get(field) if isinstance(value, dict) else getattr(value, field, None)
+
+# Append-only journal: save_db with keys appends one record per key to
+# "<file>.journal" instead of rewriting the whole file. load_db replays the
+# journal on top of the snapshot, and the journal is folded back into the
+# snapshot once it grows past the threshold.
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_COMPACT_THRESHOLD = 10000
+
+# Write-behind flusher: save_db only marks records dirty, and a background
+# thread coalesces everything saved within FLUSH_INTERVAL seconds into one
+# journal append or snapshot per file. 0 writes synchronously.
+FLUSH_INTERVAL = float(os.environ.get("PAINEL_FLUSH_INTERVAL", "0.2"))
+
+journal_counts = {}
+pending_writes = {}
+pending_lock = threading.Condition()
+flush_lock = threading.RLock()
+flusher_thread = None
+# Held by whatever changes the in-memory stores (POST requests, the expiry
+# scheduler) so a backup never copies half of a change that spans records or
+# stores, like a new client and its reseller's client list
+store_lock = threading.RLock()
+
+def replay_journal(data: Dict, file_path: str, journal_path: str) -> int:
+    if not os.path.exists(journal_path):
+        return 0
+    applied = 0
+    with open(journal_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping truncated journal entry in {journal_path}")
+                continue
+            if entry["op"] == "set":
+                data[entry["key"]] = decode_record(file_path, entry["value"])
+            elif entry["op"] == "del":
+                data.pop(entry["key"], None)
+            applied += 1
+    return applied
+
+def dump_record(value) -> str:
+    # Routes mutate records without locking, so a nested dict may change size
+    # while we serialize it; just try again.
+    for _ in range(5):
+        try:
+            return json.dumps(value, default=encode_record)
+        except RuntimeError:
+            continue
+    return json.dumps(value, default=encode_record)
+
+def snapshot_lines(data: Dict):
+    # Still one JSON object, but with one record per line so load_json_db can
+    # stream it back without holding the whole document in memory
+    items = list(data.copy().items())
+    yield "{\n"
+    for index, (key, value) in enumerate(items):
+        yield json.dumps(key) + ": " + dump_record(value) + (",\n" if index < len(items) - 1 else "\n")
+    yield "}\n"
+
+def stream_records(f, file_path: str):
+    decoder = json.JSONDecoder()
+    if f.readline().strip() != "{":
+        raise ValueError("not a line-per-record snapshot")
+    for line in f:
+        line = line.strip()
+        if line == "}":
+            return
+        key, end = decoder.raw_decode(line)
+        if line[end:end + 1] != ":":
+            raise ValueError("not a line-per-record snapshot")
+        value, end = decoder.raw_decode(line, end + 1 + (line[end + 1:end + 2] == " "))
+        yield key, decode_record(file_path, value)
+    raise ValueError("truncated snapshot")
+
+def read_snapshot(file_path: str) -> Dict:
+    with open(file_path, "r") as f:
+        try:
+            return dict(stream_records(f, file_path))
+        except ValueError:
+            # Files written with indent=4 by older versions; the next snapshot
+            # rewrites them in the streaming layout
+            f.seek(0)
+            return {key: decode_record(file_path, value) for key, value in json.load(f).items()}
+
+def memory_usage_mb() -> float:
+    # Resident set size from /proc on Linux, peak RSS from getrusage elsewhere
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return 0.0
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def fsync_dir(file_path: str):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(file_path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def atomic_write(file_path: str, content):
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "wb" if isinstance(content, bytes) else "w") as f:
+        if isinstance(content, (str, bytes)):
+            f.write(content)
+        else:
+            f.writelines(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+    fsync_dir(file_path)
+
+def load_json_db(file_path: str, default: Dict = None) -> Dict:
+    started = time.perf_counter()
+    data = None
     if os.path.exists(file_path):
         try:
-            with open(file_path, "r") as f:
-                data = json.load(f)
-                if file_path == USERS_DB_FILE:
-                    for username in data:
-                        data[username].setdefault("credits", float('inf') if username == "admin" else 100)
-                        data[username].setdefault("infinite_credits", username == "admin")
-                        data[username].setdefault("email", "")
-                if file_path == RESELLERS_DB_FILE:
-                    for reseller in data.values():
-                        reseller.setdefault("infinite_credits", reseller.get("role") == "franchise")
-                        reseller.setdefault("email", "")
-                        reseller.setdefault("clients", [])
-                        reseller.setdefault("sub_resellers", [])
-                        reseller.setdefault("role", "simple")
-                if file_path == LAYOUT_SETTINGS_FILE:
-                    data.setdefault("client_info_template", "Usuário: #user_iptv#\nSenha: #pass_iptv#\nM3U: #url_m3u#\nDNS1: #dns_iptv#\nDNS2: #dns_iptv2#\nDNS3: #dns_iptv3#")
-                    data.setdefault("public_url2", PUBLIC_URL2)
-                    data.setdefault("public_url3", PUBLIC_URL3)
-                return data
+            data = read_snapshot(file_path)
         except json.JSONDecodeError:
-            print(f"Error decoding {file_path}. Using default.")
-            return default or {}
-    return default or {}
+            # Keep the damaged file around instead of overwriting it on the next save
+            corrupt_path = f"{file_path}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+            os.replace(file_path, corrupt_path)
+            print(f"Error decoding {file_path}, moved to {corrupt_path}. Using default.")
+    if data is None:
+        data = {key: decode_record(file_path, value) for key, value in (default or {}).items()}
+    replayed = replay_journal(data, file_path, file_path + JOURNAL_SUFFIX)
+    journal_counts[file_path] = replayed
+    if stored_schema_version < SCHEMA_VERSION:
+        migrate_records(data, file_path)
+    print(f"Loaded {len(data)} records from {file_path} ({replayed} from the journal) in "
+          f"{time.perf_counter() - started:.2f}s, RSS {memory_usage_mb():.0f} MB")
+    return data
+
+def migrate_records(data: Dict, file_path: str):
+    if file_path == USERS_DB_FILE:
+        for username in data:
+            data[username].setdefault("credits", float('inf') if username == "admin" else 100)
+            data[username].setdefault("infinite_credits", username == "admin")
+            data[username].setdefault("email", "")
+    if file_path == RESELLERS_DB_FILE:
+        for reseller in data.values():
+            reseller.setdefault("infinite_credits", reseller.get("role") == "franchise")
+            reseller.setdefault("email", "")
+            reseller.setdefault("clients", [])
+            reseller.setdefault("sub_resellers", [])
+            reseller.setdefault("role", "simple")
+    if file_path == LAYOUT_SETTINGS_FILE:
+        data.setdefault("client_info_template", "Usuário: #user_iptv#\nSenha: #pass_iptv#\nM3U: #url_m3u#\nDNS1: #dns_iptv#\nDNS2: #dns_iptv2#\nDNS3: #dns_iptv3#")
+        data.setdefault("public_url2", PUBLIC_URL2)
+        data.setdefault("public_url3", PUBLIC_URL3)
+
+def read_schema_version() -> int:
+    if STORAGE_BACKEND == "sqlite":
+        with sqlite_lock:
+            row = sqlite_connection().execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+        return int(row[0]) if row else 1
+    if os.path.exists(DB_META_FILE):
+        with open(DB_META_FILE, "r") as f:
+            return json.load(f).get("schema_version", 1)
+    return 1
+
+def write_schema_version(version: int):
+    if STORAGE_BACKEND == "sqlite":
+        with sqlite_lock:
+            sqlite_connection().execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('schema_version', ?)", (str(version),))
+    else:
+        atomic_write(DB_META_FILE, json.dumps({"schema_version": version}))
+
+def write_snapshot(data: Dict, file_path: str):
+    atomic_write(file_path, snapshot_lines(data))
+    # Everything in the journal is now part of the snapshot
+    journal_path = file_path + JOURNAL_SUFFIX
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+    journal_counts[file_path] = 0
+
+def append_journal(data: Dict, file_path: str, keys: Iterable[str]):
+    entries = []
+    for key in keys:
+        value = data.get(key)
+        if value is not None:
+            entries.append(json.dumps({"op": "set", "key": key, "value": value}, default=encode_record))
+        else:
+            entries.append(json.dumps({"op": "del", "key": key}))
+    if not entries:
+        return
+    with open(file_path + JOURNAL_SUFFIX, "a") as f:
+        f.write("\n".join(entries) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    journal_counts[file_path] = journal_counts.get(file_path, 0) + len(entries)
+    if journal_counts[file_path] >= JOURNAL_COMPACT_THRESHOLD:
+        write_snapshot(data, file_path)
+        print(f"Compacted journal of {file_path} ({len(data)} records)")
+
+def flush_pending():
+    with flush_lock:
+        with pending_lock:
+            batch = dict(pending_writes)
+            pending_writes.clear()
+        for file_path, (data, keys) in batch.items():
+            try:
+                if keys is None:
+                    write_snapshot(data, file_path)
+                else:
+                    append_journal(data, file_path, keys)
+            except Exception as e:
+                # Any failure (disk, or a value json cannot encode) keeps the
+                # keys dirty for the next tick instead of killing the flusher
+                print(f"Failed to write {file_path}: {str(e)}")
+                mark_dirty(data, file_path, keys)
+
+def flusher_loop():
+    while True:
+        with pending_lock:
+            while not pending_writes:
+                pending_lock.wait()
+        # Let the rest of the burst pile up before writing
+        time.sleep(FLUSH_INTERVAL)
+        flush_pending()
+
+def start_flusher():
+    global flusher_thread
+    # Threads do not survive a fork, so each gunicorn worker starts its own
+    if flusher_thread is None or not flusher_thread.is_alive():
+        flusher_thread = threading.Thread(target=flusher_loop, daemon=True)
+        flusher_thread.start()
+
+def mark_dirty(data: Dict, file_path: str, keys: Iterable[str] = None):
+    with pending_lock:
+        pending = pending_writes.get(file_path)
+        if keys is None:
+            pending_writes[file_path] = (data, None)
+        elif pending is None:
+            pending_writes[file_path] = (data, set(keys))
+        elif pending[1] is not None:
+            pending[1].update(keys)
+        pending_lock.notify()
+
+def save_db(data: Dict, file_path: str, keys: Iterable[str] = None):
+    if keys is not None:
+        keys = list(keys)
+    if file_path == CLIENTS_DB_FILE:
+        index_clients(keys)
+        schedule_expiry(keys)
+    elif file_path == RESELLERS_DB_FILE:
+        index_resellers(keys)
+    if isinstance(data, SQLiteStore):
+        data.save(keys)
+        return
+    mark_dirty(data, file_path, keys)
+    if FLUSH_INTERVAL <= 0:
+        flush_pending()
+    else:
+        start_flusher()
+
+atexit.register(flush_pending)
+
+sqlite_conn = None
+sqlite_pid = None
+sqlite_lock = threading.RLock()
+
+def sqlite_connection() -> sqlite3.Connection:
+    global sqlite_conn, sqlite_pid
+    # Connections must not cross a fork (gunicorn --preload)
+    if sqlite_conn is None or sqlite_pid != os.getpid():
+        sqlite_conn = sqlite3.connect(SQLITE_DB_FILE, timeout=30, isolation_level=None, check_same_thread=False)
+        sqlite_conn.execute("PRAGMA journal_mode=WAL")
+        sqlite_conn.execute("PRAGMA synchronous=NORMAL")
+        sqlite_conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        sqlite_pid = os.getpid()
+    return sqlite_conn
+
+class SQLiteStore(MutableMapping):
+    """Dict-like store backed by one SQLite table with a JSON row per key.
+
+    Records are cached after the first read so routes can keep mutating them
+    in place and then call save_db(store, file, keys) as with the JSON files.
+    """
+
+    def __init__(self, table: str, columns: Iterable[str] = (), decode=None):
+        self.table = table
+        self.columns = tuple(columns)
+        self.decode = decode or (lambda value: value)
+        self.cache = {}
+        self.data_version = None
+        extra_columns = "".join(f", {column} TEXT" for column in self.columns)
+        with sqlite_lock:
+            conn = sqlite_connection()
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL{extra_columns})")
+            existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            for column in self.columns:
+                if column not in existing:
+                    # Indexed column added after the table was created: fill it from the rows
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT")
+                    conn.execute(f"UPDATE {table} SET {column} = json_extract(value, '$.{column}')")
+            for column in self.columns:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_{column} ON {table} ({column})")
+            self.data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def query(self, sql: str, params: tuple = ()) -> list:
+        with sqlite_lock:
+            return sqlite_connection().execute(sql, params).fetchall()
+
+    def refresh(self):
+        # data_version only changes when another connection (worker) committed
+        version = self.query("PRAGMA data_version")[0][0]
+        if version != self.data_version:
+            self.cache.clear()
+            self.data_version = version
+
+    def row(self, key: str, value) -> tuple:
+        indexed = tuple(record_field(value, column) for column in self.columns)
+        return (key, json.dumps(value, default=encode_record)) + indexed
+
+    def write(self, items: list):
+        placeholders = ", ".join("?" * (2 + len(self.columns)))
+        names = ", ".join(("key", "value") + self.columns)
+        with sqlite_lock:
+            conn = sqlite_connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(f"INSERT OR REPLACE INTO {self.table} ({names}) VALUES ({placeholders})",
+                                 [self.row(key, value) for key, value in items])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def __getitem__(self, key: str):
+        if key in self.cache:
+            return self.cache[key]
+        rows = self.query(f"SELECT value FROM {self.table} WHERE key = ?", (key,))
+        if not rows:
+            raise KeyError(key)
+        value = self.cache[key] = self.decode(json.loads(rows[0][0]))
+        return value
+
+    def __setitem__(self, key: str, value):
+        self.cache[key] = value
+        self.write([(key, value)])
+
+    def __delitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+        self.cache.pop(key, None)
+        self.query(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def __contains__(self, key) -> bool:
+        return key in self.cache or bool(self.query(f"SELECT 1 FROM {self.table} WHERE key = ?", (key,)))
+
+    def __iter__(self):
+        return iter([row[0] for row in self.query(f"SELECT key FROM {self.table}")])
+
+    def __len__(self) -> int:
+        return self.query(f"SELECT COUNT(*) FROM {self.table}")[0][0]
+
+    def items(self) -> list:
+        items = []
+        for key, value in self.query(f"SELECT key, value FROM {self.table}"):
+            if key not in self.cache:
+                self.cache[key] = self.decode(json.loads(value))
+            items.append((key, self.cache[key]))
+        return items
+
+    def values(self) -> list:
+        return [value for _, value in self.items()]
+
+    def copy(self) -> Dict:
+        return dict(self.items())
+
+    def find(self, column: str, value: str) -> List[str]:
+        return [row[0] for row in self.query(f"SELECT key FROM {self.table} WHERE {column} = ?", (value,))]
+
+    def find_items(self, column: str, value: str) -> Dict:
+        items = {}
+        for key, row_value in self.query(f"SELECT key, value FROM {self.table} WHERE {column} = ?", (value,)):
+            if key not in self.cache:
+                self.cache[key] = self.decode(json.loads(row_value))
+            items[key] = self.cache[key]
+        return items
+
+    def save(self, keys: Iterable[str] = None):
+        if keys is None:
+            keys = [key for key, _ in self.items()]
+        items, deleted = [], []
+        for key in keys:
+            if key in self.cache:
+                items.append((key, self.cache[key]))
+            elif key not in self:
+                deleted.append((key,))
+        if items:
+            self.write(items)
+        if deleted:
+            with sqlite_lock:
+                sqlite_connection().executemany(f"DELETE FROM {self.table} WHERE key = ?", deleted)
+
+def load_db(file_path: str, default: Dict = None) -> Dict:
+    if STORAGE_BACKEND != "sqlite":
+        return load_json_db(file_path, default)
+    table, columns = SQLITE_TABLES[file_path]
+    store = SQLiteStore(table, columns, lambda value: decode_record(file_path, value))
+    # Import the JSON data once, the first time the table is used
+    if not store.query("SELECT 1 FROM meta WHERE key = ?", (f"imported:{table}",)):
+        data = load_json_db(file_path, default)
+        store.write(list(data.items()))
+        store.query("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"imported:{table}", datetime.now().isoformat()))
+        print(f"Imported {len(data)} records from {file_path} into {SQLITE_DB_FILE}")
+    return store
+
+# In-memory indexes for the JSON backend (SQLite has real indexes), kept in
+# step with clients_db and resellers_db by save_db
+client_name_index = {}
+client_owner_index = {}
+client_package_index = {}
+client_status_counts = {}
+client_index_entries = {}
+reseller_creator_index = {}
+reseller_package_index = {}
+reseller_index_entries = {}
+
+def count_status(owner: str, status: str, delta: int):
+    for counts in (client_status_counts.setdefault(owner, {}), client_status_counts.setdefault(None, {})):
+        counts[status] = counts.get(status, 0) + delta
+
+def index_clients(keys: Iterable[str] = None):
+    if isinstance(clients_db, SQLiteStore):
+        return
+    if keys is None:
+        client_name_index.clear()
+        client_owner_index.clear()
+        client_package_index.clear()
+        client_status_counts.clear()
+        client_index_entries.clear()
+        keys = list(clients_db)
+    for client_id in keys:
+        old = client_index_entries.pop(client_id, None)
+        if old is not None:
+            name, owner, status, package = old
+            if client_name_index.get(name) == client_id:
+                del client_name_index[name]
+            client_owner_index.get(owner, {}).pop(client_id, None)
+            client_package_index.get(package, {}).pop(client_id, None)
+            count_status(owner, status, -1)
+        client = clients_db.get(client_id)
+        if client is not None:
+            client_name_index[client.name] = client_id
+            # Dicts keep the listing in creation order
+            client_owner_index.setdefault(client.owner, {})[client_id] = None
+            if client.package:
+                client_package_index.setdefault(client.package, {})[client_id] = None
+            count_status(client.owner, client.status, 1)
+            client_index_entries[client_id] = (client.name, client.owner, client.status, client.package)
+
+def index_resellers(keys: Iterable[str] = None):
+    if isinstance(resellers_db, SQLiteStore):
+        return
+    if keys is None:
+        reseller_creator_index.clear()
+        reseller_package_index.clear()
+        reseller_index_entries.clear()
+        keys = list(resellers_db)
+    for name in keys:
+        old = reseller_index_entries.pop(name, None)
+        if old is not None:
+            old_creator, old_package = old
+            reseller_creator_index.get(old_creator, {}).pop(name, None)
+            reseller_package_index.get(old_package, {}).pop(name, None)
+        reseller = resellers_db.get(name)
+        if reseller is not None:
+            if "created_by" in reseller:
+                reseller_creator_index.setdefault(reseller["created_by"], {})[name] = None
+            if reseller.get("package"):
+                reseller_package_index.setdefault(reseller["package"], {})[name] = None
+            reseller_index_entries[name] = (reseller.get("created_by"), reseller.get("package"))
+
+def find_client_id(name: str) -> Optional[str]:
+    if isinstance(clients_db, SQLiteStore):
+        client_ids = clients_db.find("name", name)
+        return client_ids[0] if client_ids else None
+    return client_name_index.get(name)
 
-def save_db(data: Dict, file_path: str):
-    with open(file_path, "w") as f:
-        json.dump(data, f, indent=4)
+def owner_clients(owner: str) -> Dict:
+    if isinstance(clients_db, SQLiteStore):
+        return clients_db.find_items("owner", owner)
+    return {cid: clients_db[cid] for cid in list(client_owner_index.get(owner, ()))}
+
+def package_users(package_id: str) -> List[str]:
+    """Ids of the clients and names of the resellers given this package."""
+    if isinstance(clients_db, SQLiteStore):
+        return clients_db.find("package", package_id) + resellers_db.find("package", package_id)
+    return list(client_package_index.get(package_id, ())) + list(reseller_package_index.get(package_id, ()))
+
+def owner_status_counts(owner: str = None) -> Dict[str, int]:
+    """Clients per status for one owner, or for the whole panel when owner is None."""
+    if isinstance(clients_db, SQLiteStore):
+        where, params = ("WHERE owner = ?", (owner,)) if owner is not None else ("", ())
+        rows = clients_db.query(f"SELECT json_extract(value, '$.status'), COUNT(*) FROM clients {where} GROUP BY 1", params)
+        return {status: count for status, count in rows}
+    return {status: count for status, count in client_status_counts.get(owner, {}).items() if count}
+
+# Expiry scheduler: a min-heap of (expires_at, client_id) drained by a
+# background thread, which flips due clients to "expired" and persists them in
+# one batch. Requests only compare client.expires_at. expiry_scheduled holds
+# the expires_at each client last got an entry for, so saves that do not
+# change it (blocking, connection edits) push nothing.
+expiry_heap = []
+expiry_scheduled = {}
+expiry_lock = threading.Lock()
+expiry_thread = None
+
+def schedule_expiry(keys: Iterable[str] = None):
+    if keys is None:
+        records = list(clients_db.items())
+    else:
+        records = [(client_id, clients_db.get(client_id)) for client_id in keys]
+    with expiry_lock:
+        for client_id, client in records:
+            if client is not None and client.status == "active" and expiry_scheduled.get(client_id) != client.expires_at:
+                expiry_scheduled[client_id] = client.expires_at
+                heapq.heappush(expiry_heap, (client.expires_at, client_id))
+
+def expire_clients(now: float = None) -> List[str]:
+    now = now or time.time()
+    due = []
+    with expiry_lock:
+        while expiry_heap and expiry_heap[0][0] < now:
+            expires_at, client_id = heapq.heappop(expiry_heap)
+            # Older entries of a renewed client leave its current one scheduled
+            if expiry_scheduled.get(client_id) == expires_at:
+                del expiry_scheduled[client_id]
+            due.append(client_id)
+    expired = []
+    with store_lock:
+        for client_id in due:
+            client = clients_db.get(client_id)
+            # Entries for deleted or renewed clients are just dropped
+            if client is not None and client.status == "active" and client.expires_at < now:
+                client.status = "expired"
+                expired.append(client_id)
+        if expired:
+            save_db(clients_db, CLIENTS_DB_FILE, expired)
+    if expired:
+        print(f"Expired {len(expired)} clients")
+    return expired
+
+def expiry_loop():
+    while True:
+        try:
+            expire_clients()
+        except Exception as e:
+            print(f"Expiry scheduler failed: {str(e)}")
+        time.sleep(EXPIRY_CHECK_INTERVAL)
+
+def start_expiry_scheduler():
+    global expiry_thread
+    if expiry_thread is None or not expiry_thread.is_alive():
+        expiry_thread = threading.Thread(target=expiry_loop, daemon=True)
+        expiry_thread.start()
+
+def created_resellers(creator: str) -> Dict:
+    if isinstance(resellers_db, SQLiteStore):
+        return resellers_db.find_items("created_by", creator)
+    return {name: resellers_db[name] for name in list(reseller_creator_index.get(creator, ()))}
 
 def sanitize_credentials(text: str) -> str:
     """Remove caracteres especiais, permitindo apenas alfanuméricos, _ e -."""
     return re.sub(r'[^a-zA-Z0-9_-]', '', text)
 
+stored_schema_version = read_schema_version()
 users_db = load_db(USERS_DB_FILE, {"admin": {"password": "admin123", "role": "admin", "credits": float('inf'), "infinite_credits": True, "email": ""}})
 clients_db = load_db(CLIENTS_DB_FILE, {})
 resellers_db = load_db(RESELLERS_DB_FILE, {})
@@ -84,50 +852,949 @@ layout_settings_db = load_db(LAYOUT_SETTINGS_FILE, {
     "public_url3": PUBLIC_URL3
 })
 
-def fetch_m3u(url: str) -> List[Dict]:
+# Channel packages: {package_id: {"name": ..., "groups": [group-title, ...]}}.
+# A client sees the package it was given, else the nearest one up its chain of
+# resellers (see client_package), else everything.
+packages_db = load_db(PACKAGES_DB_FILE, {})
+
+def all_stores() -> Dict[str, Dict]:
+    return {USERS_DB_FILE: users_db, CLIENTS_DB_FILE: clients_db, RESELLERS_DB_FILE: resellers_db, LAYOUT_SETTINGS_FILE: layout_settings_db,
+            PACKAGES_DB_FILE: packages_db}
+
+if stored_schema_version < SCHEMA_VERSION:
+    for file_path, data in all_stores().items():
+        save_db(data, file_path)
+    flush_pending()
+    write_schema_version(SCHEMA_VERSION)
+    print(f"Migrated databases from schema {stored_schema_version} to {SCHEMA_VERSION}")
+
+index_clients()
+index_resellers()
+schedule_expiry()
+
+@app.before_request
+def refresh_stores():
+    # Pick up rows committed by other workers since the last request
+    for store in all_stores().values():
+        if isinstance(store, SQLiteStore):
+            store.refresh()
+    start_expiry_scheduler()
+    start_stream_prober()
+
+@app.before_request
+def lock_stores():
+    # Every route that writes to the stores is a POST
+    if request.method == "POST" and STORAGE_BACKEND != "sqlite":
+        store_lock.acquire()
+        request.environ["painel.store_lock"] = True
+
+@app.teardown_request
+def unlock_stores(exc=None):
+    if request.environ.pop("painel.store_lock", False):
+        store_lock.release()
+
+backup_lock = threading.Lock()
+
+def capture_stores() -> Dict[str, Dict[str, str]]:
+    """Point-in-time copy of every store as {file_path: {key: record JSON}}."""
+    if STORAGE_BACKEND == "sqlite":
+        # A separate connection in one read transaction sees a single WAL
+        # snapshot of every table without holding up the request threads
+        conn = sqlite3.connect(SQLITE_DB_FILE, timeout=30, isolation_level=None)
+        try:
+            conn.execute("BEGIN")
+            captured = {file_path: dict(conn.execute(f"SELECT key, value FROM {table}").fetchall())
+                        for file_path, (table, _) in SQLITE_TABLES.items()}
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return captured
+    # Copied while no POST request or expiry run is changing any store, so
+    # every store and record comes from the same moment; the slow part,
+    # serializing, runs after the lock is released
+    with store_lock:
+        copies = {file_path: {key: copy_record(value) for key, value in store.items()} for file_path, store in all_stores().items()}
+    return {file_path: {key: dump_record(value) for key, value in records.items()} for file_path, records in copies.items()}
+
+def copy_record(value):
+    """Copy deep enough that later in-place edits (Client fields, a reseller's
+    clients list) cannot reach it; strings and numbers are shared."""
+    if isinstance(value, dict):
+        return {key: copy_record(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_record(item) for item in value]
+    if isinstance(value, Client):
+        # The dict encode_record would produce anyway, and cheaper than copy.copy
+        return value.to_dict()
+    return copy.copy(value)
+
+def record_hash(record: str) -> str:
+    return hashlib.blake2b(record.encode(), digest_size=8).hexdigest()
+
+def read_backup_manifest() -> Optional[Dict]:
+    if not os.path.exists(BACKUP_MANIFEST):
+        return None
+    with open(BACKUP_MANIFEST, "r") as f:
+        return json.load(f)
+
+def list_backups() -> List[Dict]:
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    return [{"name": name, "size_kb": os.path.getsize(os.path.join(BACKUP_DIR, name)) // 1024}
+            for name in sorted(os.listdir(BACKUP_DIR), reverse=True) if name.endswith(".jsonl.gz")]
+
+def create_backup(full: bool = False) -> str:
+    with backup_lock:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        manifest = read_backup_manifest()
+        incremental = not full and manifest is not None
+        started = time.perf_counter()
+        captured = capture_stores()
+        hashes = {file_path: {key: record_hash(record) for key, record in records.items()} for file_path, records in captured.items()}
+        name = f"{'incr' if incremental else 'full'}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.jsonl.gz"
+        path = os.path.join(BACKUP_DIR, name)
+        header = {"type": "incremental" if incremental else "full", "created_at": datetime.now().isoformat(),
+                  "parent": manifest["last"] if incremental else None}
+        written = 0
+        with gzip.open(path + ".tmp", "wt") as f:
+            f.write(json.dumps(header) + "\n")
+            for file_path, records in captured.items():
+                previous = manifest["hashes"].get(file_path, {}) if incremental else {}
+                for key, record in records.items():
+                    if previous.get(key) != hashes[file_path][key]:
+                        f.write(f'{{"store": {json.dumps(file_path)}, "key": {json.dumps(key)}, "value": {record}}}\n')
+                        written += 1
+                for key in previous.keys() - records.keys():
+                    f.write(json.dumps({"store": file_path, "key": key, "deleted": True}) + "\n")
+                    written += 1
+        os.replace(path + ".tmp", path)
+        atomic_write(BACKUP_MANIFEST, json.dumps({"last": name, "hashes": hashes}))
+        print(f"Backup {name} written with {written} records in {time.perf_counter() - started:.2f}s")
+        return name
+
+def backup_chain(name: str) -> List[str]:
+    chain = []
+    while name:
+        chain.append(name)
+        with gzip.open(os.path.join(BACKUP_DIR, name), "rt") as f:
+            name = json.loads(f.readline())["parent"]
+    return chain[::-1]
+
+def restore_backup(name: str):
+    restored = {file_path: {} for file_path in all_stores()}
+    for part in backup_chain(name):
+        with gzip.open(os.path.join(BACKUP_DIR, part), "rt") as f:
+            f.readline()
+            for line in f:
+                entry = json.loads(line)
+                if entry.get("deleted"):
+                    restored[entry["store"]].pop(entry["key"], None)
+                else:
+                    restored[entry["store"]][entry["key"]] = decode_record(entry["store"], entry["value"])
+    for file_path, store in all_stores().items():
+        if isinstance(store, SQLiteStore):
+            store.query(f"DELETE FROM {store.table}")
+            store.cache.clear()
+            store.write(list(restored[file_path].items()))
+        else:
+            store.clear()
+            store.update(restored[file_path])
+            save_db(store, file_path)
+    flush_pending()
+    index_clients()
+    index_resellers()
+    schedule_expiry()
+    # The next backup has to start a new chain from the restored state
+    if os.path.exists(BACKUP_MANIFEST):
+        os.remove(BACKUP_MANIFEST)
+    print(f"Restored {name} ({len(restored[CLIENTS_DB_FILE])} clients)")
+
+@app.cli.command("backup")
+@click.option("--full", is_flag=True, help="Write a full snapshot instead of an incremental backup.")
+def backup_command(full):
+    """Back up users, clients, resellers and layout settings."""
+    click.echo(create_backup(full))
+
+@app.cli.command("restore")
+@click.argument("name")
+def restore_command(name):
+    """Restore the stores from a backup (and the chain it belongs to).
+
+    With the JSON storage, stop the panel first: running workers would
+    overwrite the restored files with their own pending writes."""
+    restore_backup(name)
+    if STORAGE_BACKEND != "sqlite":
+        click.echo("Start the panel again so it loads the restored files.")
+
+def parse_m3u(lines: Iterable[str]) -> Iterable[Channel]:
+    """Yields channels one at a time so no full copy of the playlist is kept."""
+    current_channel = None
+    channel_index = 0
+    for line in lines:
+        line = line.strip()
+        if line.startswith("#EXTINF:"):
+            current_channel = None
+            match = EXTINF_FIXED_RE.match(line)
+            if match:
+                # The line is stripped and the regex skips the blanks after the comma
+                tvg_id, name, logo, group, title = match.groups()
+                name = (name or title or f"Channel_{channel_index}").strip()
+                current_channel = (tvg_id or name, name, logo, group or "Outros", title)
+                current_attrs = None
+                channel_index += 1
+                continue
+            match = EXTINF_RE.match(line)
+            if match:
+                header, title = match.groups()
+            else:
+                # An unbalanced quote: fall back to the first comma
+                header, _, title = line[8:].partition(",")
+            attrs = {key: double or single or bare for key, double, single, bare in EXTINF_ATTRIBUTE_RE.findall(header)}
+            title = title.strip()
+            name = (attrs.pop("tvg-name", "") or title or f"Channel_{channel_index}").strip()
+            # tvg-chno, catchup, tvg-rec... stay in attrs and are passed through to the playlists as-is
+            current_channel = (attrs.pop("tvg-id", "") or name, name, attrs.pop("tvg-logo", ""),
+                               attrs.pop("group-title", "") or "Outros", title)
+            current_attrs = attrs
+            channel_index += 1
+        elif current_channel and line.startswith("http"):
+            yield Channel(*current_channel, line, current_attrs)
+            current_channel = None
+
+def fetch_m3u(url: str, validators: Optional[Dict] = None, transfer: Optional[Dict] = None) -> Optional[List[Channel]]:
+    """Downloads and parses the playlist. validators holds the ETag,
+    Last-Modified and body hash of the previous download and is updated in
+    place; when the upstream answers 304 or sends the same body again the
+    parse is skipped and None is returned. transfer, if given, receives the
+    content encoding and the bytes on the wire vs decoded."""
+    if validators is None:
+        validators = {}
+    if transfer is None:
+        transfer = {}
     session = requests.Session()
     retry_strategy = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
     adapter = HTTPAdapter(max_retries=retry_strategy)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
-    headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
+    headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36", "Accept-Encoding": ACCEPT_ENCODING}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
     try:
-        response = session.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
-        lines = response.text.splitlines()
-        channels = []
-        current_channel = {}
-        channel_index = 0
-        for line in lines:
-            line = line.strip()
-            if not line or line.startswith("#EXTM3U"):
-                continue
-            if line.startswith("#EXTINF:"):
-                match = re.search(r'tvg-id="([^"]*)"\s*tvg-name="([^"]*)"\s*tvg-logo="([^"]*)"\s*group-title="([^"]*)"\s*,(.+)', line)
-                if not match:
-                    match = re.search(r'-1\s+(?:tvg-id="([^"]*)"\s*)?(?:tvg-name="([^"]*)"\s*)?(?:tvg-logo="([^"]*)"\s*)?(?:group-title="([^"]*)"\s*)?,(.+)', line)
-                if match:
-                    tvg_id, name, logo, group, title = match.groups()
-                    name = name or title or f"Channel_{channel_index}"
-                    group = group or "Outros"
-                    current_channel = {
-                        "tvg_id": tvg_id or name,
-                        "name": name.strip(),
-                        "logo": logo or "",
-                        "group": group,
-                        "title": title.strip()
-                    }
-                    channel_index += 1
-            elif line.startswith("http") and current_channel:
-                current_channel["url"] = line
-                channels.append(current_channel)
-                current_channel = {}
+        # Stream the body to a temporary file while hashing it: memory stays at
+        # one chunk and an unchanged body is never parsed
+        with session.get(url, headers=headers, timeout=30, stream=True) as response, tempfile.TemporaryFile() as body:
+            if response.status_code == 304:
+                print(f"Playlist not modified at {url}")
+                return None
+            response.raise_for_status()
+            digest = hashlib.blake2b(digest_size=16)
+            started = time.perf_counter()
+            decoded = 0
+            # urllib3 decompresses chunk by chunk as the body arrives
+            for chunk in response.iter_content(M3U_CHUNK_SIZE):
+                digest.update(chunk)
+                body.write(chunk)
+                decoded += len(chunk)
+            elapsed = time.perf_counter() - started
+            transferred = response.raw.tell() or decoded
+            transfer.update(encoding=response.headers.get("Content-Encoding", "identity"), transferred=transferred, decoded=decoded,
+                            # What the same link would have needed for the uncompressed body
+                            seconds_saved=elapsed * (decoded / transferred - 1) if transferred else 0.0)
+            print(f"Downloaded {url}: {transferred / 2**20:.1f} MB transferred ({transfer['encoding']}) for {decoded / 2**20:.1f} MB of playlist in {elapsed:.2f}s, ~{transfer['seconds_saved']:.2f}s saved")
+            validators["etag"] = response.headers.get("ETag")
+            validators["last_modified"] = response.headers.get("Last-Modified")
+            if digest.hexdigest() == validators.get("content_hash"):
+                print(f"Playlist body unchanged at {url}")
+                return None
+            validators["content_hash"] = digest.hexdigest()
+            body.seek(0)
+            with gc_paused():
+                channels = list(parse_m3u(io.TextIOWrapper(body, encoding=response.encoding or "utf-8", errors="replace")))
         print(f"Fetched {len(channels)} channels from {url}")
         return channels
     except requests.exceptions.RequestException as e:
         print(f"Failed to fetch M3U: {str(e)}")
         return []
 
+def diff_channels(old: List[Channel], new: List[Channel]) -> Dict[str, int]:
+    """Counts of added, removed and changed channels for /cache_status.
+    Channels are matched by stream URL; changed means the same stream with
+    different name, logo, group, title or attributes. Only counts are kept so
+    the previous list can be freed."""
+    old_by_url = {channel.url: channel for channel in old}
+    added = changed = 0
+    for channel in new:
+        previous = old_by_url.pop(channel.url, None)
+        if previous is None:
+            added += 1
+        elif previous.signature() != channel.signature():
+            changed += 1
+    return {"added": added, "removed": len(old_by_url), "changed": changed}
+
+def set_channels(channels: List[Channel], version: Optional[str], updated: datetime):
+    channels_cache["last_diff"] = diff_channels(channels_cache["data"], channels)
+    channels_cache["data"] = channels
+    channels_cache["version"] = version
+    channels_cache["last_updated"] = updated
+    channels_cache["generation"] += 1
+    diff = channels_cache["last_diff"]
+    print(f"Channel list updated: {diff['added']} added, {diff['removed']} removed, {diff['changed']} changed")
+
+def fetch_source(source: Dict) -> Optional[List[Channel]]:
+    """fetch_m3u for one source, keeping its validators, last good list and stats."""
+    state = channels_cache["sources"].get(source["name"]) or {"validators": {}, "channels": []}
+    # Conditional request only when there is a list to fall back on
+    validators = dict(state["validators"]) if state["channels"] else {}
+    started = time.perf_counter()
+    transfer = {}
+    channels = fetch_m3u(source["url"], validators, transfer)
+    stats = source_stats[source["name"]]
+    if transfer:
+        stats["transfer"] = transfer
+    stats["last_duration"] = time.perf_counter() - started
+    stats["total_duration"] += stats["last_duration"]
+    if channels is None or channels:
+        stats["successes"] += 1
+        stats["last_success"] = datetime.now()
+        stats["last_outcome"] = "sem alterações" if channels is None else "ok"
+        channels_cache["sources"][source["name"]] = {"validators": validators, "channels": state["channels"] if channels is None else channels}
+        stats["channels"] = len(channels_cache["sources"][source["name"]]["channels"])
+    else:
+        stats["failures"] += 1
+        stats["last_outcome"] = "falha"
+    return channels
+
+def normalized_prefix(url_prefix: str) -> str:
+    """Scheme and host lowercased and the default port dropped, so the same
+    stream written two ways compares equal."""
+    parts = urlsplit(url_prefix)
+    netloc = parts.netloc.lower()
+    default_port = {"http": ":80", "https": ":443"}.get(parts.scheme.lower())
+    if default_port and netloc.endswith(default_port):
+        netloc = netloc[:-len(default_port)]
+    return f"{parts.scheme.lower()}://{netloc}{parts.path}"
+
+def merge_channels(lists: List[List[Channel]]) -> List[Channel]:
+    """Concatenates the sources in priority order, dropping the channels a
+    higher priority source already has: the same stream URL (normalized), or
+    the same tvg-id when the entry has one. An entry without tvg-id gets its
+    name as tvg_id, so those are matched by URL only and two different
+    streams that share a name are both kept. Duplicates inside one source
+    are left alone."""
+    merged = []
+    seen_urls = set()
+    seen_ids = set()
+    # Prefixes are interned and shared, so each is normalized once
+    prefixes = {}
+    for channels in lists:
+        urls = set()
+        ids = set()
+        for channel in channels:
+            prefix = prefixes.get(channel.url_prefix)
+            if prefix is None:
+                prefix = prefixes[channel.url_prefix] = normalized_prefix(channel.url_prefix)
+            url = (prefix, channel.url_path)
+            tvg_id = channel.tvg_id.lower() if channel.tvg_id != channel.name else None
+            if url in seen_urls or (tvg_id is not None and tvg_id in seen_ids):
+                continue
+            merged.append(channel)
+            urls.add(url)
+            if tvg_id is not None:
+                ids.add(tvg_id)
+        seen_urls |= urls
+        seen_ids |= ids
+    return merged
+
+def fetch_sources() -> tuple:
+    """Fetches every source concurrently. Returns (channels, version): channels
+    is None when the merged list would be the same as the cached one and []
+    when every source failed."""
+    with ThreadPoolExecutor(max_workers=len(M3U_SOURCES)) as pool:
+        results = list(pool.map(fetch_source, M3U_SOURCES))
+    healthy = sorted((source for source, channels in zip(M3U_SOURCES, results) if channels is None or channels),
+                     key=lambda source: source.get("priority", 0))
+    if not healthy:
+        return [], None
+    version = "|".join(f"{source['name']}:{channels_cache['sources'][source['name']]['validators'].get('content_hash')}" for source in healthy)
+    if version == channels_cache["version"] and channels_cache["data"]:
+        return None, version
+    return merge_channels([channels_cache["sources"][source["name"]]["channels"] for source in healthy]), version
+
+channels_refresh_lock = threading.Lock()
+
+@contextmanager
+def host_refresh_lock():
+    """Serializes playlist refreshes across the worker processes of a host."""
+    if fcntl is None:
+        yield
+        return
+    with open(CHANNELS_LOCK_FILE, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def refresh_due() -> bool:
+    return channels_cache["last_attempt"] is None or datetime.now() - channels_cache["last_attempt"] > CACHE_RETRY_INTERVAL
+
+def write_channels_snapshot(channels: List[Channel], version: Optional[str]):
+    """Header pickle (format, version) followed by the body, so a reader can
+    tell whether it already has this list without loading it. Channels are
+    stored once in a table; the merged list and each source refer to them by
+    index."""
+    table = []
+    positions = {}
+    def refs(channel_list):
+        indexes = array("I")
+        for channel in channel_list:
+            index = positions.get(id(channel))
+            if index is None:
+                index = positions[id(channel)] = len(table)
+                table.append(channel)
+            indexes.append(index)
+        return indexes
+    body = {
+        "channels": refs(channels),
+        "sources": {name: {"validators": state["validators"], "channels": refs(state["channels"])} for name, state in channels_cache["sources"].items()}
+    }
+    body["table"] = pack_channels(table)
+    with gc_paused():
+        content = pickle.dumps({"format": CHANNELS_SNAPSHOT_FORMAT, "version": version}, pickle.HIGHEST_PROTOCOL) + pickle.dumps(body, pickle.HIGHEST_PROTOCOL)
+    atomic_write(CHANNELS_SNAPSHOT_FILE, content)
+
+def read_channels_snapshot(skip_version: Optional[str] = None) -> Optional[Dict]:
+    """Returns {"version", "channels", "sources"}, or only the version when it
+    equals skip_version; None if the file is missing or unreadable."""
+    try:
+        with open(CHANNELS_SNAPSHOT_FILE, "rb") as f:
+            header = pickle.load(f)
+            if not isinstance(header, dict) or header.get("format") != CHANNELS_SNAPSHOT_FORMAT:
+                return None
+            if skip_version and header["version"] == skip_version:
+                return {"version": header["version"]}
+            with gc_paused():
+                body = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError) as e:
+        print(f"Could not read {CHANNELS_SNAPSHOT_FILE}: {str(e)}")
+        return None
+    table = unpack_channels(body["table"])
+    return {
+        "version": header["version"],
+        "channels": list(map(table.__getitem__, body["channels"])),
+        "sources": {name: {"validators": state["validators"], "channels": list(map(table.__getitem__, state["channels"]))}
+                    for name, state in body["sources"].items()}
+    }
+
+def load_shared_channels() -> bool:
+    """Takes the list another worker fetched, if it is newer than ours and not expired."""
+    try:
+        modified = datetime.fromtimestamp(os.path.getmtime(CHANNELS_SNAPSHOT_FILE))
+    except OSError:
+        return False
+    if datetime.now() - modified > CACHE_TIMEOUT or (channels_cache["last_updated"] and modified <= channels_cache["last_updated"]):
+        return False
+    snapshot = read_channels_snapshot(skip_version=channels_cache["version"])
+    if snapshot is None:
+        return False
+    if "channels" not in snapshot:
+        # Same playlist (the other worker got 304s or identical bodies)
+        channels_cache["last_updated"] = modified
+    else:
+        set_channels(snapshot["channels"], snapshot["version"], modified)
+        channels_cache["sources"] = snapshot["sources"]
+    channels_cache["last_outcome"] = f"ok: {len(channels_cache['data'])} canais (de outro worker)"
+    return True
+
+def load_channels_snapshot():
+    """Warm start: serve the last parsed list, however old, from the first
+    request on; get_channels refreshes it in the background once expired."""
+    if not os.path.exists(CHANNELS_SNAPSHOT_FILE):
+        return
+    started = time.perf_counter()
+    snapshot = read_channels_snapshot()
+    if snapshot is None:
+        return
+    channels_cache["data"] = snapshot["channels"]
+    channels_cache["generation"] += 1
+    channels_cache["version"] = snapshot["version"]
+    channels_cache["sources"] = snapshot["sources"]
+    channels_cache["last_updated"] = datetime.fromtimestamp(os.path.getmtime(CHANNELS_SNAPSHOT_FILE))
+    channels_cache["last_outcome"] = f"ok: {len(snapshot['channels'])} canais (snapshot)"
+    print(f"Loaded {len(snapshot['channels'])} channels from {CHANNELS_SNAPSHOT_FILE} in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+def cache_state() -> tuple:
+    return (channels_cache["last_updated"], channels_cache["generation"], channels_cache["last_attempt"])
+
+def refresh_channels(wait: bool = False, seen: Optional[tuple] = None):
+    """Fetches the playlist and swaps it into the cache; a failed or empty
+    fetch keeps the last good list. Single-flight: with wait=False the call
+    returns at once if a refresh is already running, with wait=True it waits
+    for that refresh and only fetches again if it left the cache empty. seen
+    is the cache_state() the caller decided on; if a refresh or attempt
+    changed it by the time both locks are held, nothing is fetched."""
+    if seen is None:
+        seen = cache_state()
+    if not channels_refresh_lock.acquire(blocking=wait):
+        return
+    try:
+        with host_refresh_lock():
+            # Checked with both locks held, so a refresh that finished while
+            # this call waited (or was being scheduled) is not repeated
+            if channels_cache["data"] and cache_state() != seen:
+                return
+            if wait and (channels_cache["data"] or not refresh_due()):
+                return
+            if load_shared_channels():
+                return
+            started = datetime.now()
+            channels_cache["last_attempt"] = started
+            channels, version = fetch_sources()
+            channels_cache["last_duration"] = (datetime.now() - started).total_seconds()
+            if channels is None:
+                # Unchanged upstream: touch the snapshot so the other workers see a fresh list
+                if os.path.exists(CHANNELS_SNAPSHOT_FILE):
+                    os.utime(CHANNELS_SNAPSHOT_FILE)
+                else:
+                    write_channels_snapshot(channels_cache["data"], version)
+                channels_cache["last_updated"] = datetime.fromtimestamp(os.path.getmtime(CHANNELS_SNAPSHOT_FILE))
+                channels_cache["last_outcome"] = f"ok: {len(channels_cache['data'])} canais (sem alterações)"
+            elif channels:
+                write_channels_snapshot(channels, version)
+                set_channels(channels, version, datetime.fromtimestamp(os.path.getmtime(CHANNELS_SNAPSHOT_FILE)))
+                channels_cache["last_outcome"] = f"ok: {len(channels)} canais"
+            else:
+                channels_cache["last_outcome"] = "falha: mantendo a lista anterior" if channels_cache["data"] else "falha: nenhuma lista"
+                print(f"Channel refresh failed, serving {len(channels_cache['data'])} cached channels")
+    finally:
+        channels_refresh_lock.release()
+
+def get_channels() -> List[Channel]:
+    """Stale-while-revalidate: an expired cache is refreshed in the background
+    while requests keep getting the last good list. Only a cold cache is
+    fetched on the request path, and concurrent cold requests share one fetch."""
+    seen = cache_state()
+    if not channels_cache["data"]:
+        refresh_channels(wait=True, seen=seen)
+        return channels_cache["data"]
+    stale = channels_cache["last_updated"] is None or datetime.now() - channels_cache["last_updated"] > CACHE_TIMEOUT
+    if stale and refresh_due() and not channels_refresh_lock.locked():
+        threading.Thread(target=refresh_channels, kwargs={"seen": seen}, daemon=True).start()
+    return channels_cache["data"]
+
+def channels_cache_status() -> Dict:
+    def seconds_since(moment):
+        return int((datetime.now() - moment).total_seconds()) if moment else None
+    return {
+        "channels": len(channels_cache["data"]),
+        "age_seconds": seconds_since(channels_cache["last_updated"]),
+        "last_attempt_seconds_ago": seconds_since(channels_cache["last_attempt"]),
+        "last_outcome": channels_cache["last_outcome"],
+        "last_duration_seconds": channels_cache["last_duration"],
+        "last_diff": channels_cache["last_diff"],
+        "refreshing": channels_refresh_lock.locked(),
+        "dead_channels": len(dead_urls),
+        "compression": compression_stats["encodings"],
+        "compression_bytes_saved": compression_stats["bytes_saved"],
+        "last_probe_seconds_ago": seconds_since(probe_stats["last_run"]),
+        "last_probe_duration_seconds": probe_stats["last_duration"],
+        "probed_streams": probe_stats["checked"],
+        "probe_role": probe_stats["role"],
+        "sources": [{
+            "name": name,
+            "priority": stats["priority"],
+            "channels": stats["channels"],
+            "successes": stats["successes"],
+            "failures": stats["failures"],
+            "last_outcome": stats["last_outcome"],
+            "last_duration_seconds": stats["last_duration"],
+            "avg_duration_seconds": stats["total_duration"] / (stats["successes"] + stats["failures"]) if stats["successes"] + stats["failures"] else None,
+            "last_success_seconds_ago": seconds_since(stats["last_success"]),
+            "last_transfer": stats["transfer"]
+        } for name, stats in source_stats.items()]
+    }
+
+load_channels_snapshot()
+
+class ChannelHealth:
+    """Probe history of one stream URL: bit i of history is the result of the
+    i-th most recent check (1 = alive)."""
+    __slots__ = ("history", "checks", "last_checked", "last_status")
+
+    def __init__(self):
+        self.history = 0
+        self.checks = 0
+        self.last_checked = None
+        self.last_status = None
+
+    def record(self, alive: bool, status: str):
+        self.history = ((self.history << 1) | alive) & 0xFFFF
+        self.checks += 1
+        self.last_checked = int(time.time())
+        self.last_status = status
+
+    @property
+    def dead(self) -> bool:
+        return self.checks >= PROBE_DEAD_AFTER and not self.history & ((1 << PROBE_DEAD_AFTER) - 1)
+
+channel_health: Dict[str, ChannelHealth] = {}
+dead_urls = frozenset()
+probe_stats = {"last_run": None, "last_duration": None, "checked": 0, "role": None}
+prober_thread = None
+# Open (and flock'ed) for as long as this process is the host's prober
+prober_lock_file = None
+# Hash of the DEAD_URLS_FILE content last loaded; timestamps are too coarse
+# on some filesystems to tell two prober writes apart
+dead_urls_digest = None
+
+async def probe_url(url: str, host_limits: Dict[str, asyncio.Semaphore], context: ssl.SSLContext) -> tuple:
+    """(alive, status) from a HEAD request, retried as a 1-byte GET when the
+    server does not allow HEAD. Redirects count as alive."""
+    parts = urlsplit(url)
+    path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    host_limit = host_limits.setdefault(parts.netloc, asyncio.Semaphore(PROBE_PER_HOST))
+    async with host_limit:
+        for method, extra in (("HEAD", ""), ("GET", "Range: bytes=0-0\r\n")):
+            writer = None
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(parts.hostname, port, ssl=context if parts.scheme == "https" else None),
+                    PROBE_TIMEOUT)
+                writer.write(f"{method} {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nUser-Agent: Mozilla/5.0\r\n{extra}Connection: close\r\n\r\n".encode())
+                status_line = await asyncio.wait_for(reader.readline(), PROBE_TIMEOUT)
+                status = int(status_line.split()[1])
+            except (OSError, asyncio.TimeoutError, ValueError, IndexError) as e:
+                return False, type(e).__name__
+            finally:
+                if writer:
+                    writer.close()
+            if status not in (405, 501):
+                return status < 400, str(status)
+        return False, str(status)
+
+async def probe_urls(urls: List[str]) -> Dict[str, tuple]:
+    """PROBE_CONCURRENCY workers pull from one iterator, so memory does not
+    grow with the number of channels."""
+    results = {}
+    pending = iter(urls)
+    host_limits = {}
+    context = ssl.create_default_context()
+
+    async def worker():
+        for url in pending:
+            results[url] = await probe_url(url, host_limits, context)
+
+    await asyncio.gather(*(worker() for _ in range(PROBE_CONCURRENCY)))
+    return results
+
+def probe_channels():
+    """One probe round over the cached channels; updates the health history
+    and the set of URLs hidden from the playlists."""
+    started = time.perf_counter()
+    urls = list({channel.url for channel in channels_cache["data"]})
+    results = asyncio.run(probe_urls(urls))
+    for url, (alive, status) in results.items():
+        channel_health.setdefault(url, ChannelHealth()).record(alive, status)
+    # Forget channels that left the playlist
+    for url in channel_health.keys() - results.keys():
+        del channel_health[url]
+    set_dead_urls(frozenset(url for url, health in channel_health.items() if health.dead))
+    atomic_write(DEAD_URLS_FILE, json.dumps(sorted(dead_urls)))
+    probe_stats.update(last_run=datetime.now(), last_duration=time.perf_counter() - started, checked=len(urls))
+    print(f"Probed {len(urls)} streams in {probe_stats['last_duration']:.1f}s: {sum(alive for alive, _ in results.values())} alive, {len(dead_urls)} hidden as dead")
+
+def set_dead_urls(dead: frozenset):
+    global dead_urls
+    if dead != dead_urls:
+        dead_urls = dead
+        # Playlists rendered with the previous set are stale
+        channels_cache["generation"] += 1
+
+def load_dead_urls():
+    """Takes the dead URLs the host's prober last wrote, if the content changed."""
+    global dead_urls_digest
+    try:
+        with open(DEAD_URLS_FILE, "rb") as f:
+            content = f.read()
+        digest = hashlib.blake2b(content, digest_size=12).digest()
+        if digest == dead_urls_digest:
+            return
+        dead = frozenset(json.loads(content))
+    except (OSError, ValueError) as e:
+        if not isinstance(e, FileNotFoundError):
+            print(f"Could not read {DEAD_URLS_FILE}: {str(e)}")
+        return
+    dead_urls_digest = digest
+    set_dead_urls(dead)
+
+def become_prober() -> bool:
+    """True if this process is (now) the host's prober."""
+    global prober_lock_file
+    if prober_lock_file is not None or fcntl is None:
+        return True
+    lock_file = open(PROBE_LOCK_FILE, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    prober_lock_file = lock_file
+    return True
+
+def prober_loop():
+    while True:
+        try:
+            if become_prober():
+                probe_stats["role"] = "prober"
+                if channels_cache["data"]:
+                    probe_channels()
+            else:
+                probe_stats["role"] = "follower"
+                load_dead_urls()
+        except Exception as e:
+            print(f"Stream prober failed: {str(e)}")
+        time.sleep(PROBE_INTERVAL if probe_stats["role"] == "prober" else min(PROBE_INTERVAL, PROBE_FOLLOW_INTERVAL))
+
+def start_stream_prober():
+    global prober_thread
+    if PROBE_INTERVAL and (prober_thread is None or not prober_thread.is_alive()):
+        prober_thread = threading.Thread(target=prober_loop, daemon=True)
+        prober_thread.start()
+
+def live_channels() -> List[Channel]:
+    """get_channels() without the channels the prober found dead."""
+    channels = get_channels()
+    if not dead_urls:
+        return channels
+    hidden = dead_urls
+    return [channel for channel in channels if channel.url not in hidden]
+
+# Rendered playlists of the current cache generation. "channels" are the live
+# channels and "group_ids" the bit of each one's group in "group_bits", so the
+# channel list of a package is one mask test per channel; "selections" keeps
+# those lists and "streams" the get_live_streams payload per entitlement;
+# "entitlements" keeps each package's (entitlement key, groups).
+# Playlists are keyed by slot ("<entitlement>/<variant>"), their compressed
+# copies by (slot, content encoding), and their ETags are a hash of the
+# rendered bytes, so every worker computes the same one.
+rendered_playlists = {"generation": None, "channels": [], "group_bits": {}, "group_ids": [], "entitlements": {}, "selections": {},
+                      "streams": {}, "variants": {}, "encoded": {}, "etags": {}}
+render_lock = threading.Lock()
+# Encodings prepared in the background for each rendered playlist, preferred first
+PLAYLIST_ENCODINGS = {"gzip": lambda content: gzip.compress(content, 9)}
+if brotli is not None:
+    PLAYLIST_ENCODINGS = {"br": lambda content: brotli.compress(content, quality=9), **PLAYLIST_ENCODINGS}
+# get.php output= values and the stream extension each playlist variant uses;
+# anything else gets the upstream URLs unchanged
+OUTPUT_FORMATS = {"ts": "ts", "mpegts": "ts", "hls": "m3u8", "m3u8": "m3u8"}
+# Last compression cost per encoding, and bytes not sent thanks to it
+compression_stats = {"encodings": {}, "bytes_saved": 0}
+# Streaming mode: get.php sends the shared buffer in fixed-size chunks with
+# chunked transfer encoding instead of one body with a Content-Length, so
+# servers or middleware that copy/buffer the body per request only ever hold
+# one chunk. Plain mode already shares the buffer without copying it.
+PLAYLIST_STREAMING = os.environ.get("PAINEL_STREAM_PLAYLIST", "0") == "1"
+PLAYLIST_CHUNK_SIZE = 64 * 1024
+
+def output_prefix(url_prefix: str, extension: str) -> str:
+    """Xtream-style servers only serve HLS under /live/user/pass/; the short
+    /user/pass/ form is MPEG-TS only."""
+    parts = urlsplit(url_prefix)
+    segments = parts.path.strip("/").split("/")
+    if extension == "m3u8" and len(segments) == 2:
+        return f"{parts.scheme}://{parts.netloc}/live/{parts.path.lstrip('/')}"
+    return url_prefix
+
+def output_url(channel: Channel, extension: Optional[str], prefixes: Dict[str, str]) -> str:
+    """The channel URL with the live stream extension of the requested output.
+    VOD (movie/series) files and URLs that are not <id>[.ts|.m3u8] keep the
+    upstream URL."""
+    if not extension or "/movie/" in channel.url_prefix or "/series/" in channel.url_prefix:
+        return channel.url
+    stem, dot, current = channel.url_path.rpartition(".")
+    if not dot:
+        stem, current = channel.url_path, ""
+    if current not in ("", "ts", "m3u8") or not stem.isdigit():
+        return channel.url
+    # Only a handful of distinct prefixes exist, so each is rewritten once per render
+    prefix = prefixes.get(channel.url_prefix)
+    if prefix is None:
+        prefix = prefixes[channel.url_prefix] = output_prefix(channel.url_prefix, extension)
+    return f"{prefix}{stem}.{extension}"
+
+def render_m3u(channels: List[Channel], extension: Optional[str] = None) -> bytes:
+    grouped_channels = {}
+    for channel in channels:
+        grouped_channels.setdefault(channel.group, []).append(channel)
+    prefixes = {}
+    lines = ["#EXTM3U"]
+    for group, group_channels in grouped_channels.items():
+        for channel in group_channels:
+            extra = "".join(f' {key}="{value}"' for key, value in channel.attrs.items()) if channel.attrs else ""
+            lines.append(f'#EXTINF:-1 tvg-id="{channel.tvg_id}" tvg-name="{channel.name}" tvg-logo="{channel.logo}" group-title="{group}"{extra},{channel.title}')
+            lines.append(output_url(channel, extension, prefixes) if extension else channel.url)
+    lines.append("")
+    return "\n".join(lines).encode()
+
+def iter_chunks(content: bytes) -> Iterable[bytes]:
+    view = memoryview(content)
+    for offset in range(0, len(view), PLAYLIST_CHUNK_SIZE):
+        yield bytes(view[offset:offset + PLAYLIST_CHUNK_SIZE])
+
+def compress_playlist(rendered: Dict, slot: str, content: bytes):
+    for encoding, compress in PLAYLIST_ENCODINGS.items():
+        started = time.thread_time()
+        compressed = compress(content)
+        cpu_seconds = time.thread_time() - started
+        rendered["encoded"][(slot, encoding)] = compressed
+        compression_stats["encodings"][encoding] = {"identity_bytes": len(content), "compressed_bytes": len(compressed), "cpu_seconds": cpu_seconds}
+        print(f"Compressed {slot} playlist with {encoding}: {len(content)} -> {len(compressed)} bytes, {cpu_seconds:.2f}s CPU")
+
+def client_package(client: Client) -> Optional[str]:
+    """The package deciding what the client sees: its own, else the nearest
+    one up its chain of resellers (owner, its creator, ...), else None."""
+    if client.package:
+        return client.package
+    reseller, seen = client.owner, set()
+    # Stops at the admin or system that created the top reseller
+    while reseller not in seen:
+        seen.add(reseller)
+        record = resellers_db.get(reseller)
+        if record is None:
+            return None
+        if record.get("package"):
+            return record["package"]
+        reseller = record.get("created_by")
+    return None
+
+# Entitlement of clients without a package: (entitlement key, groups)
+ALL_CHANNELS = ("all", None)
+
+def client_entitlement(client: Client) -> Tuple[str, Optional[frozenset]]:
+    """(entitlement key, group titles) of what the client may see; an
+    unknown package allows nothing."""
+    package_id = client_package(client)
+    if not package_id:
+        return ALL_CHANNELS
+    return package_entitlement(current_render(), package_id)
+
+def package_entitlement(rendered: Dict, package_id: str) -> Tuple[str, Optional[frozenset]]:
+    # Worked out once per package and generation. Packages are never edited,
+    # only created under a new id, so the id alone identifies the groups.
+    entitlement = rendered["entitlements"].get(package_id)
+    if entitlement is None:
+        groups = frozenset(packages_db.get(package_id, {}).get("groups", ()))
+        entitlement = rendered["entitlements"][package_id] = (entitlement_key(groups), groups)
+    return entitlement
+
+def entitlement_key(groups: frozenset) -> str:
+    # Keyed by the group set rather than the package, so packages with the
+    # same groups share their selection and rendered playlists
+    return "pkg-" + hashlib.blake2b("\n".join(sorted(groups)).encode(), digest_size=8).hexdigest()
+
+def current_render() -> Dict:
+    """rendered_playlists for the current cache generation, started afresh
+    with the group bitsets of the new channel list when it changed. A cached
+    generation costs one comparison; the dead channels are only filtered out
+    when a new one is started."""
+    global rendered_playlists
+    # Starts the background refresh when stale (and fetches when cold)
+    get_channels()
+    if rendered_playlists["generation"] == channels_cache["generation"]:
+        return rendered_playlists
+    with render_lock:
+        # Generation first: the list read after it is never older than it
+        generation = channels_cache["generation"]
+        if rendered_playlists["generation"] != generation:
+            channels = live_channels()
+            group_bits = {}
+            group_ids = [group_bits.setdefault(channel.group, len(group_bits)) for channel in channels]
+            # Swapped as a whole so readers never pair a generation with another one's bytes
+            rendered_playlists = {"generation": generation, "channels": channels, "group_bits": group_bits, "group_ids": group_ids,
+                                  "entitlements": {}, "selections": {}, "streams": {}, "variants": {}, "encoded": {}, "etags": {}}
+        return rendered_playlists
+
+def package_channels(rendered: Dict, entitlement: Tuple[str, Optional[frozenset]]) -> List[Channel]:
+    key, groups = entitlement
+    if groups is None:
+        return rendered["channels"]
+    selection = rendered["selections"].get(key)
+    if selection is None:
+        mask = 0
+        for group in groups:
+            if group in rendered["group_bits"]:
+                mask |= 1 << rendered["group_bits"][group]
+        selection = [channel for channel, group_id in zip(rendered["channels"], rendered["group_ids"]) if mask >> group_id & 1]
+        rendered["selections"][key] = selection
+    return selection
+
+def encoded_playlist(variant: str, accept_encodings, entitlement: Tuple[str, Optional[frozenset]] = ALL_CHANNELS) -> tuple:
+    """(body, content encoding, ETag, uncompressed size) for the client's
+    Accept-Encoding; the uncompressed playlist until the compressed copies are
+    ready. Each encoding gets its own strong ETag."""
+    content = playlist_bytes(variant, entitlement)
+    cached = rendered_playlists
+    slot = f"{entitlement[0]}/{variant}"
+    if cached["variants"].get(slot) is not content:
+        # A new generation was rendered in between; its copies belong to other bytes
+        return content, None, None, len(content)
+    ready = [encoding for encoding in PLAYLIST_ENCODINGS if (slot, encoding) in cached["encoded"]]
+    encoding = accept_encodings.best_match(ready) if ready else None
+    etag = f"{cached['etags'][slot]}-{encoding or 'identity'}"
+    if encoding is None:
+        return content, None, etag, len(content)
+    return cached["encoded"][(slot, encoding)], encoding, etag, len(content)
+
+def playlist_bytes(variant: str = "original", entitlement: Tuple[str, Optional[frozenset]] = ALL_CHANNELS) -> bytes:
+    """The playlist every client with the same channel groups gets, rendered
+    once per cache generation (new channel list or new set of dead channels)
+    and then shared. variant is a stream extension from OUTPUT_FORMATS or
+    "original"; entitlement comes from client_entitlement()."""
+    rendered = current_render()
+    slot = f"{entitlement[0]}/{variant}"
+    if slot in rendered["variants"]:
+        return rendered["variants"][slot]
+    if not rendered["channels"]:
+        return b""
+    channels = package_channels(rendered, entitlement)
+    with render_lock:
+        if slot not in rendered["variants"]:
+            started = time.perf_counter()
+            content = render_m3u(channels, None if variant == "original" else variant)
+            rendered["etags"][slot] = f"{variant}-{hashlib.blake2b(content, digest_size=12).hexdigest()}"
+            rendered["variants"][slot] = content
+            print(f"Rendered {slot} playlist with {len(channels)} channels in {time.perf_counter() - started:.2f}s")
+            threading.Thread(target=compress_playlist, args=(rendered, slot, content), daemon=True).start()
+        return rendered["variants"][slot]
+
+def live_streams_json(entitlement: Tuple[str, Optional[frozenset]] = ALL_CHANNELS) -> bytes:
+    """The get_live_streams payload, built once per cache generation and
+    entitlement like the playlists."""
+    rendered = current_render()
+    key = entitlement[0]
+    content = rendered["streams"].get(key)
+    if content is not None:
+        return content
+    if not rendered["channels"]:
+        return b""
+    added = str(int(time.time()))
+    streams = [{
+        "stream_id": channel.tvg_id,
+        "name": channel.name,
+        "logo": channel.logo,
+        "epg_channel_id": channel.tvg_id,
+        "category_id": "1" if channel.group != "Outros" else "2",
+        "stream_type": "live",
+        "stream_url": channel.url,
+        "added": added,
+        "is_adult": 0
+    } for channel in package_channels(rendered, entitlement)]
+    content = rendered["streams"][key] = json.dumps(streams, separators=(",", ":")).encode()
+    return content
+
 login_html = """
 <!DOCTYPE html>
 <html>
@@ -196,6 +1863,7 @@ sidebar_html = """
             <li><a href="{{ url_for('ger_resellers') }}" class="block px-4 py-2 hover:bg-gray-700 rounded">Ger. Revendas</a></li>
             {% endif %}
             {% if role == 'admin' %}
+            <li><a href="{{ url_for('ger_pacotes') }}" class="block px-4 py-2 hover:bg-gray-700 rounded">Pacotes</a></li>
             <li><a href="{{ url_for('ferramenta') }}" class="block px-4 py-2 hover:bg-gray-700 rounded">Ferramentas</a></li>
             {% endif %}
             <li><a href="{{ url_for('logout') }}" class="block px-4 py-2 hover:bg-gray-700 rounded">Sair</a></li>
@@ -223,6 +1891,7 @@ dashboard_html = """
             <div class="bg-white p-6 rounded-lg shadow">
                 <h3 class="text-xl font-bold mb-2">Clientes</h3>
                 <p class="text-2xl">{{ clients_count }}</p>
+                <p class="text-sm text-gray-600">Ativos: {{ status_counts.get('active', 0) }} · Bloqueados: {{ status_counts.get('blocked', 0) }} · Expirados: {{ status_counts.get('expired', 0) }}</p>
             </div>
             {% if role == 'admin' or role == 'master' or role == 'franchise' %}
             <div class="bg-white p-6 rounded-lg shadow">
@@ -294,6 +1963,14 @@ ger_clientes_html = """
                 alert(result.message);
             }
         }
+        async function setPackage(url, packageId) {
+            const response = await fetch(url, { method: 'POST', body: new URLSearchParams({ package: packageId }) });
+            const result = await response.json();
+            if (!result.success) {
+                alert(result.message);
+                location.reload();
+            }
+        }
         async function deleteClient(clientId) {
             if (confirm('Tem certeza que deseja excluir este cliente?')) {
                 const response = await fetch(`/delete_client/${clientId}`, { method: 'POST' });
@@ -345,6 +2022,17 @@ ger_clientes_html = """
                         <button type="button" onclick="adjustValue('months', 1)" class="bg-gray-300 hover:bg-gray-400 text-gray-800 font-bold py-1 px-2 rounded-r">+</button>
                     </div>
                 </div>
+                {% if role == 'admin' %}
+                <div class="mb-4">
+                    <label class="block text-gray-700 text-sm font-bold mb-2" for="package">Pacote de Canais</label>
+                    <select class="shadow appearance-none border rounded w-full py-2 px-3 text-gray-700 leading-tight focus:outline-none focus:shadow-outline" id="package" name="package">
+                        <option value="">Todos os canais</option>
+                        {% for package_id, package in packages.items() %}
+                        <option value="{{ package_id }}">{{ package.name }}</option>
+                        {% endfor %}
+                    </select>
+                </div>
+                {% endif %}
                 <button class="bg-blue-500 hover:bg-blue-700 text-white font-bold py-2 px-4 rounded focus:outline-none focus:shadow-outline" type="submit">Criar</button>
             </form>
         </div>
@@ -359,6 +2047,7 @@ ger_clientes_html = """
                             <th class="py-2 px-4 border-b">Conexões</th>
                             <th class="py-2 px-4 border-b">Vencimento</th>
                             <th class="py-2 px-4 border-b">Status</th>
+                            <th class="py-2 px-4 border-b">Pacote</th>
                             <th class="py-2 px-4 border-b">Ações</th>
                         </tr>
                     </thead>
@@ -371,6 +2060,18 @@ ger_clientes_html = """
                             <td class="py-2 px-4 border-b">{{ client.connections }}</td>
                             <td class="py-2 px-4 border-b">{{ client.expiry_date }}</td>
                             <td class="py-2 px-4 border-b">{{ client.status }}</td>
+                            <td class="py-2 px-4 border-b">
+                                {% if role == 'admin' %}
+                                <select onchange="setPackage('/update_client_package/{{ client_id }}', this.value)" class="border rounded py-1 px-2 text-gray-700">
+                                    <option value="">Padrão da revenda</option>
+                                    {% for package_id, package in packages.items() %}
+                                    <option value="{{ package_id }}" {% if client.package == package_id %}selected{% endif %}>{{ package.name }}</option>
+                                    {% endfor %}
+                                </select>
+                                {% else %}
+                                {{ packages[client.package].name if client.package in packages else '-' }}
+                                {% endif %}
+                            </td>
                             <td class="py-2 px-4 border-b">
                                 <a href="{{ url_for('client_info', client_id=client_id) }}" class="text-blue-500 hover:text-blue-700 mr-2">Ver Infos</a>
                                 <button onclick="toggleBlock('{{ client_id }}')" class="text-{{ 'red' if client.status == 'active' else 'green' }}-500 hover:text-{{ 'red' if client.status == 'active' else 'green' }}-700 mr-2">{{ 'Bloquear' if client.status == 'active' else 'Desbloquear' }}</button>
@@ -396,6 +2097,14 @@ ger_resellers_html = """
     <meta name="viewport" content="width=device-width, initial-scale=1">
     <script src="https://cdn.tailwindcss.com"></script>
     <script>
+        async function setPackage(url, packageId) {
+            const response = await fetch(url, { method: 'POST', body: new URLSearchParams({ package: packageId }) });
+            const result = await response.json();
+            if (!result.success) {
+                alert(result.message);
+                location.reload();
+            }
+        }
         async function deleteReseller(resellerName) {
             if (confirm('Tem certeza que deseja excluir esta revenda?')) {
                 const response = await fetch(`/delete_reseller/${resellerName}`, { method: 'POST' });
@@ -446,6 +2155,17 @@ ger_resellers_html = """
                         {% endif %}
                     </select>
                 </div>
+                {% if role == 'admin' %}
+                <div class="mb-4">
+                    <label class="block text-gray-700 text-sm font-bold mb-2" for="package">Pacote de Canais</label>
+                    <select class="shadow appearance-none border rounded w-full py-2 px-3 text-gray-700 leading-tight focus:outline-none focus:shadow-outline" id="package" name="package">
+                        <option value="">Todos os canais</option>
+                        {% for package_id, package in packages.items() %}
+                        <option value="{{ package_id }}">{{ package.name }}</option>
+                        {% endfor %}
+                    </select>
+                </div>
+                {% endif %}
                 <button class="bg-blue-500 hover:bg-blue-700 text-white font-bold py-2 px-4 rounded focus:outline-none focus:shadow-outline" type="submit">Criar</button>
             </form>
         </div>
@@ -458,6 +2178,7 @@ ger_resellers_html = """
                             <th class="py-2 px-4 border-b">Nome</th>
                             <th class="py-2 px-4 border-b">Cargo</th>
                             <th class="py-2 px-4 border-b">Créditos</th>
+                            <th class="py-2 px-4 border-b">Pacote</th>
                             <th class="py-2 px-4 border-b">Ações</th>
                         </tr>
                     </thead>
@@ -468,6 +2189,18 @@ ger_resellers_html = """
                             <td class="py-2 px-4 border-b">{{ reseller_name }}</td>
                             <td class="py-2 px-4 border-b">{{ reseller.role }}</td>
                             <td class="py-2 px-4 border-b">{{ 'Infinitos' if reseller.infinite_credits else reseller.credits }}</td>
+                            <td class="py-2 px-4 border-b">
+                                {% if role == 'admin' %}
+                                <select onchange="setPackage('/update_reseller_package/{{ reseller_name }}', this.value)" class="border rounded py-1 px-2 text-gray-700">
+                                    <option value="">Todos os canais</option>
+                                    {% for package_id, package in packages.items() %}
+                                    <option value="{{ package_id }}" {% if reseller.package == package_id %}selected{% endif %}>{{ package.name }}</option>
+                                    {% endfor %}
+                                </select>
+                                {% else %}
+                                {{ packages[reseller.package].name if reseller.package in packages else '-' }}
+                                {% endif %}
+                            </td>
                             <td class="py-2 px-4 border-b">
                                 <button onclick="deleteReseller('{{ reseller_name }}')" class="text-red-500 hover:text-red-700">Excluir</button>
                             </td>
@@ -483,6 +2216,88 @@ ger_resellers_html = """
 </html>
 """
 
+ger_pacotes_html = """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Pacotes de Canais</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <script src="https://cdn.tailwindcss.com"></script>
+    <script>
+        async function deletePackage(packageId) {
+            if (confirm('Tem certeza que deseja excluir este pacote?')) {
+                const response = await fetch(`/delete_package/${packageId}`, { method: 'POST' });
+                const result = await response.json();
+                if (result.success) {
+                    location.reload();
+                } else {
+                    alert(result.message);
+                }
+            }
+        }
+    </script>
+</head>
+<body class="bg-gray-100">
+    {{ sidebar|safe }}
+    <div class="ml-64 p-6">
+        <h2 class="text-2xl font-bold mb-6">Pacotes de Canais</h2>
+        <div class="bg-white p-6 rounded-lg shadow mb-6">
+            <h3 class="text-xl font-bold mb-4">Criar Pacote</h3>
+            {% with messages = get_flashed_messages() %}
+                {% if messages %}
+                    <div class="bg-green-100 border border-green-400 text-green-700 px-4 py-3 rounded mb-4">
+                        {{ messages[0] }}
+                    </div>
+                {% endif %}
+            {% endwith %}
+            <form method="POST" action="{{ url_for('ger_pacotes') }}">
+                <div class="mb-4">
+                    <label class="block text-gray-700 text-sm font-bold mb-2" for="package_name">Nome do Pacote</label>
+                    <input class="shadow appearance-none border rounded w-full py-2 px-3 text-gray-700 leading-tight focus:outline-none focus:shadow-outline" id="package_name" name="package_name" type="text" placeholder="Nome do Pacote">
+                </div>
+                <div class="mb-4">
+                    <p class="block text-gray-700 text-sm font-bold mb-2">Grupos</p>
+                    <div class="grid grid-cols-3 gap-2 max-h-64 overflow-y-auto">
+                        {% for group in groups %}
+                        <label class="text-gray-700"><input type="checkbox" name="groups" value="{{ group }}" class="mr-2">{{ group }}</label>
+                        {% endfor %}
+                    </div>
+                </div>
+                <button class="bg-blue-500 hover:bg-blue-700 text-white font-bold py-2 px-4 rounded focus:outline-none focus:shadow-outline" type="submit">Criar</button>
+            </form>
+        </div>
+        <div class="bg-white p-6 rounded-lg shadow">
+            <h3 class="text-xl font-bold mb-4">Lista de Pacotes</h3>
+            <div class="overflow-x-auto">
+                <table class="min-w-full bg-white">
+                    <thead>
+                        <tr>
+                            <th class="py-2 px-4 border-b">Nome</th>
+                            <th class="py-2 px-4 border-b">Grupos</th>
+                            <th class="py-2 px-4 border-b">Canais</th>
+                            <th class="py-2 px-4 border-b">Ações</th>
+                        </tr>
+                    </thead>
+                    <tbody>
+                        {% for package_id, package in packages.items() %}
+                        <tr>
+                            <td class="py-2 px-4 border-b">{{ package.name }}</td>
+                            <td class="py-2 px-4 border-b">{{ package.groups|join(', ') }}</td>
+                            <td class="py-2 px-4 border-b">{{ channel_counts[package_id] }}</td>
+                            <td class="py-2 px-4 border-b">
+                                <button onclick="deletePackage('{{ package_id }}')" class="text-red-500 hover:text-red-700">Excluir</button>
+                            </td>
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
+            </div>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
 client_info_html = """
 <!DOCTYPE html>
 <html>
@@ -535,12 +2350,71 @@ ferramenta_html = """
     {{ sidebar|safe }}
     <div class="ml-64 p-6">
         <h2 class="text-2xl font-bold mb-6">Ferramentas</h2>
+        {% with messages = get_flashed_messages() %}
+            {% if messages %}
+                <div class="bg-green-100 border border-green-400 text-green-700 px-4 py-3 rounded mb-4">
+                    {{ messages[0] }}
+                </div>
+            {% endif %}
+        {% endwith %}
         <div class="bg-white p-6 rounded-lg shadow mb-6">
             <h3 class="text-xl font-bold mb-4">Manutenção</h3>
             <form method="POST" action="{{ url_for('toggle_maintenance') }}">
                 <button class="bg-{{ 'red' if maintenance_mode else 'green' }}-500 hover:bg-{{ 'red' if maintenance_mode else 'green' }}-700 text-white font-bold py-2 px-4 rounded" type="submit">{{ 'Desativar Manutenção' if maintenance_mode else 'Ativar Manutenção' }}</button>
             </form>
         </div>
+        <div class="bg-white p-6 rounded-lg shadow mb-6">
+            <h3 class="text-xl font-bold mb-4">Cache de Canais</h3>
+            <p class="text-gray-700">Canais em cache: {{ cache_status.channels }}</p>
+            <p class="text-gray-700">Idade do cache: {{ cache_status.age_seconds if cache_status.age_seconds is not none else '-' }} s</p>
+            <p class="text-gray-700">Última atualização: {{ cache_status.last_outcome or 'nenhuma' }}{% if cache_status.refreshing %} (atualizando...){% endif %}</p>
+            <p class="text-gray-700">Canais offline ocultos: {{ cache_status.dead_channels }} de {{ cache_status.probed_streams }} verificados</p>
+            {% for encoding, stats in cache_status.compression.items() %}
+            <p class="text-gray-700">Playlist {{ encoding }}: {{ '%.1f' % (stats.identity_bytes / 1048576) }} MB → {{ '%.1f' % (stats.compressed_bytes / 1048576) }} MB ({{ '%.2f' % stats.cpu_seconds }} s de CPU por atualização)</p>
+            {% endfor %}
+            <p class="text-gray-700">Tráfego economizado com compressão: {{ '%.1f' % (cache_status.compression_bytes_saved / 1048576) }} MB</p>
+            <table class="w-full text-sm mt-4">
+                <thead>
+                    <tr class="text-left text-gray-600">
+                        <th>Fonte</th>
+                        <th>Prioridade</th>
+                        <th>Canais</th>
+                        <th>Sucessos / Falhas</th>
+                        <th>Último resultado</th>
+                        <th>Tempo médio</th>
+                        <th>Transferência</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {% for source in cache_status.sources %}
+                    <tr>
+                        <td>{{ source.name }}</td>
+                        <td>{{ source.priority }}</td>
+                        <td>{{ source.channels }}</td>
+                        <td>{{ source.successes }} / {{ source.failures }}</td>
+                        <td>{{ source.last_outcome or '-' }}</td>
+                        <td>{{ '%.1f s' % source.avg_duration_seconds if source.avg_duration_seconds is not none else '-' }}</td>
+                        <td>{% if source.last_transfer %}{{ '%.1f' % (source.last_transfer.transferred / 1048576) }} / {{ '%.1f' % (source.last_transfer.decoded / 1048576) }} MB ({{ source.last_transfer.encoding }}){% else %}-{% endif %}</td>
+                    </tr>
+                    {% endfor %}
+                </tbody>
+            </table>
+        </div>
+        <div class="bg-white p-6 rounded-lg shadow mb-6">
+            <h3 class="text-xl font-bold mb-4">Backups</h3>
+            <form method="POST" action="{{ url_for('backup') }}" class="mb-4">
+                <button class="bg-blue-500 hover:bg-blue-700 text-white font-bold py-2 px-4 rounded mr-2" type="submit" name="kind" value="incremental">Backup Incremental</button>
+                <button class="bg-gray-500 hover:bg-gray-700 text-white font-bold py-2 px-4 rounded" type="submit" name="kind" value="full">Snapshot Completo</button>
+            </form>
+            <ul class="text-sm text-gray-700">
+                {% for backup in backups %}
+                <li>{{ backup.name }} ({{ backup.size_kb }} KB)</li>
+                {% else %}
+                <li>Nenhum backup criado.</li>
+                {% endfor %}
+            </ul>
+            <p class="text-sm text-gray-600 mt-2">Para restaurar: pare o painel, rode flask --app painel restore NOME e inicie o painel de novo.</p>
+        </div>
         <div class="bg-white p-6 rounded-lg shadow mb-6">
             <h3 class="text-xl font-bold mb-4">Configurações de Layout</h3>
             <form method="POST" action="{{ url_for('update_layout') }}">
@@ -602,12 +2476,10 @@ def login():
         if username in users_db and users_db[username]["password"] == password:
             session["username"] = username
             session["role"] = users_db[username]["role"]
-            save_db(users_db, USERS_DB_FILE)
             return redirect(url_for("dashboard"))
         elif username in resellers_db and resellers_db[username]["password"] == password:
             session["username"] = username
             session["role"] = resellers_db[username]["role"]
-            save_db(resellers_db, RESELLERS_DB_FILE)
             return redirect(url_for("dashboard"))
         else:
             flash("Credenciais inválidas!")
@@ -622,33 +2494,34 @@ def dashboard():
     role = session.get("role", "simple")
     if role == "admin":
         credits = users_db.get(session["username"], {}).get("credits", float('inf'))
-        clients_count = len(clients_db)
+        status_counts = owner_status_counts()
         resellers_count = len(resellers_db)
     else:
         credits = resellers_db.get(session["username"], {}).get("credits", 0)
-        reseller_clients = [cid for cid, client in clients_db.items() if client["owner"] == session["username"]]
-        clients_count = len(reseller_clients)
+        status_counts = owner_status_counts(session["username"])
         if role in ["master", "franchise"]:
-            reseller_resellers = [rid for rid, reseller in resellers_db.items() if reseller["created_by"] == session["username"]]
-            resellers_count = len(reseller_resellers)
+            resellers_count = len(created_resellers(session["username"]))
         else:
             resellers_count = 0
+    clients_count = sum(status_counts.values())
     credits_display = "Infinitos" if credits == float('inf') else str(int(credits))
     welcome_text = layout_settings_db["welcome_text"].replace("{{ username }}", session["username"])
-    layout_settings_db["welcome_text"] = welcome_text
+    # Render with a copy so the stored template keeps its placeholder
+    layout_settings = dict(layout_settings_db.items(), welcome_text=welcome_text)
     sidebar = render_template_string(sidebar_html, 
                                    username=session["username"], 
                                    credits=credits_display, 
                                    role=role, 
-                                   layout_settings=layout_settings_db)
+                                   layout_settings=layout_settings)
     return render_template_string(dashboard_html, 
                                 sidebar=sidebar,
                                 username=session["username"], 
                                 role=role, 
                                 clients_count=clients_count, 
+                                status_counts=status_counts, 
                                 resellers_count=resellers_count, 
                                 credits=credits_display, 
-                                layout_settings=layout_settings_db)
+                                layout_settings=layout_settings)
 
 @app.route("/profile", methods=["GET", "POST"])
 def profile():
@@ -672,7 +2545,7 @@ def profile():
             user_db[session["username"]]["email"] = new_email
         if new_password:
             user_db[session["username"]]["password"] = sanitize_credentials(new_password)
-        save_db(user_db, USERS_DB_FILE if role == "admin" else RESELLERS_DB_FILE)
+        save_db(user_db, USERS_DB_FILE if role == "admin" else RESELLERS_DB_FILE, [session["username"]])
         flash("Perfil atualizado com sucesso!")
         return redirect(url_for("dashboard"))
     
@@ -724,37 +2597,37 @@ def ger_clientes():
             return redirect(url_for("ger_clientes"))
         
         # Check for duplicate client name
-        if any(client["name"] == client_name for client in clients_db.values()):
+        if find_client_id(client_name):
             flash("Nome do cliente já existe!")
             return redirect(url_for("ger_clientes"))
         
+        # Only the admin picks a package; reseller clients follow their reseller's
+        package = (request.form.get("package") or None) if role == "admin" else None
+        if package and package not in packages_db:
+            flash("Pacote inválido!")
+            return redirect(url_for("ger_clientes"))
+        
         total_credits_needed = connections + months + 1
         if not has_infinite_credits and credits < total_credits_needed:
             flash("Créditos insuficientes!")
             return redirect(url_for("ger_clientes"))
         
         client_id = str(uuid.uuid4())
-        expiry_date = (datetime.now() + timedelta(days=30 * months)).strftime("%Y-%m-%d")
-        clients_db[client_id] = {
-            "name": client_name,
-            "password": client_password,
-            "connections": connections,
-            "expiry_date": expiry_date,
-            "status": "active" if datetime.strptime(expiry_date, "%Y-%m-%d") > datetime.now() else "expired",
-            "owner": session["username"]
-        }
+        expires_at = date_to_epoch((datetime.now() + timedelta(days=30 * months)).strftime("%Y-%m-%d"))
+        clients_db[client_id] = Client(client_name, client_password, connections, expires_at,
+                                       "active" if expires_at > time.time() else "expired", session["username"], package)
         
         if role != "admin":
             resellers_db[session["username"]]["clients"].append(client_id)
             if not has_infinite_credits:
                 resellers_db[session["username"]]["credits"] = max(0, credits - total_credits_needed)
-            save_db(resellers_db, RESELLERS_DB_FILE)
+            save_db(resellers_db, RESELLERS_DB_FILE, [session["username"]])
         else:
             if not has_infinite_credits:
                 users_db[session["username"]]["credits"] = max(0, credits - total_credits_needed)
-                save_db(users_db, USERS_DB_FILE)
+                save_db(users_db, USERS_DB_FILE, [session["username"]])
         
-        save_db(clients_db, CLIENTS_DB_FILE)
+        save_db(clients_db, CLIENTS_DB_FILE, [client_id])
         flash(f"Cliente {client_name} criado! Créditos usados: {total_credits_needed if not has_infinite_credits else 0}")
         return redirect(url_for("ger_clientes"))
     
@@ -764,9 +2637,11 @@ def ger_clientes():
                                    credits=credits_display, 
                                    role=role, 
                                    layout_settings=layout_settings_db)
+    clients = clients_db if role == "admin" else owner_clients(session["username"])
     return render_template_string(ger_clientes_html, 
                                 sidebar=sidebar,
-                                clients=clients_db, 
+                                clients=clients, 
+                                packages=dict(packages_db.items()), 
                                 credits=credits_display, 
                                 role=role, 
                                 layout_settings=layout_settings_db, 
@@ -813,6 +2688,12 @@ def ger_resellers():
             flash("Nome de revenda já existe!")
             return redirect(url_for("ger_resellers"))
         
+        # Only the admin picks a package; sub-resellers follow their creator's
+        package = (request.form.get("package") or None) if role == "admin" else None
+        if package and package not in packages_db:
+            flash("Pacote inválido!")
+            return redirect(url_for("ger_resellers"))
+        
         if role != "admin" and not has_infinite_credits and credits < reseller_credits + 1:
             flash("Créditos insuficientes para criar revenda!")
             return redirect(url_for("ger_resellers"))
@@ -827,7 +2708,7 @@ def ger_resellers():
                 "clients": [],
                 "sub_resellers": []
             }
-            save_db(users_db, USERS_DB_FILE)
+            save_db(users_db, USERS_DB_FILE, [reseller_name])
         else:
             resellers_db[reseller_name] = {
                 "password": reseller_password,
@@ -837,7 +2718,8 @@ def ger_resellers():
                 "created_by": session["username"],
                 "clients": [],
                 "sub_resellers": [],
-                "role": reseller_role
+                "role": reseller_role,
+                "package": package
             }
             # Ensure the creator has a sub_resellers list
             if session["username"] not in resellers_db:
@@ -854,7 +2736,7 @@ def ger_resellers():
             resellers_db[session["username"]]["sub_resellers"].append(reseller_name)
             if role != "admin" and not has_infinite_credits:
                 resellers_db[session["username"]]["credits"] = max(0, credits - (reseller_credits + 1))
-            save_db(resellers_db, RESELLERS_DB_FILE)
+            save_db(resellers_db, RESELLERS_DB_FILE, [reseller_name, session["username"]])
         
         flash(f"Revenda {reseller_name} criada com sucesso!")
         return redirect(url_for("ger_resellers"))
@@ -865,9 +2747,11 @@ def ger_resellers():
                                    credits=credits_display, 
                                    role=role, 
                                    layout_settings=layout_settings_db)
+    resellers = resellers_db if role == "admin" else created_resellers(session["username"])
     return render_template_string(ger_resellers_html, 
                                 sidebar=sidebar,
-                                resellers=resellers_db, 
+                                resellers=resellers, 
+                                packages=dict(packages_db.items()), 
                                 credits=credits_display, 
                                 role=role, 
                                 layout_settings=layout_settings_db, 
@@ -885,17 +2769,17 @@ def client_info(client_id):
         return redirect(url_for("ger_clientes"))
     
     role = session.get("role", "simple")
-    if role != "admin" and clients_db[client_id]["owner"] != session["username"]:
+    if role != "admin" and clients_db[client_id].owner != session["username"]:
         flash("Acesso negado!")
         return redirect(url_for("ger_clientes"))
     
     credits = users_db.get(session["username"], {}).get("credits", float('inf')) if role == "admin" else resellers_db.get(session["username"], {}).get("credits", 0)
     
     client = clients_db[client_id]
-    access_url = f"{PUBLIC_URL}/get.php?username={client['name']}&password={client['password']}&type=m3u_plus&output=ts"
+    access_url = f"{PUBLIC_URL}/get.php?username={client.name}&password={client.password}&type=m3u_plus&output=ts"
     client_info = layout_settings_db["client_info_template"]
-    client_info = client_info.replace("#user_iptv#", client["name"])
-    client_info = client_info.replace("#pass_iptv#", client["password"])
+    client_info = client_info.replace("#user_iptv#", client.name)
+    client_info = client_info.replace("#pass_iptv#", client.password)
     client_info = client_info.replace("#url_m3u#", access_url)
     client_info = client_info.replace("#dns_iptv#", PUBLIC_URL)
     client_info = client_info.replace("#dns_iptv2#", layout_settings_db["public_url2"])
@@ -930,10 +2814,27 @@ def ferramenta():
                                 sidebar=sidebar,
                                 credits=credits_display, 
                                 maintenance_mode=MAINTENANCE_MODE, 
+                                backups=list_backups(), 
+                                cache_status=channels_cache_status(), 
                                 layout_settings=layout_settings_db, 
                                 username=session["username"], 
                                 role="admin")
 
+@app.route("/cache_status")
+def cache_status():
+    if "username" not in session or session.get("role") != "admin":
+        return redirect(url_for("login"))
+    return jsonify(channels_cache_status())
+
+@app.route("/backup", methods=["POST"])
+def backup():
+    if "username" not in session or session.get("role") != "admin":
+        return redirect(url_for("login"))
+    full = request.form.get("kind") == "full"
+    threading.Thread(target=create_backup, args=(full,), daemon=True).start()
+    flash(f"Backup {'completo' if full else 'incremental'} iniciado!")
+    return redirect(url_for("ferramenta"))
+
 @app.route("/toggle_maintenance", methods=["POST"])
 def toggle_maintenance():
     if "username" not in session or session.get("role") != "admin":
@@ -972,37 +2873,118 @@ def logout():
     return redirect(url_for("login"))
 
 @app.route("/toggle_block/<client_id>", methods=["POST"])
-def toggle_block():
+def toggle_block(client_id):
     if "username" not in session or session.get("role") not in ["admin", "simple", "master", "franchise"]:
         return jsonify({"success": False, "message": "Acesso negado!"})
     if client_id not in clients_db:
         return jsonify({"success": False, "message": "Cliente não encontrado!"})
-    if session.get("role") != "admin" and clients_db[client_id]["owner"] != session["username"]:
+    if session.get("role") != "admin" and clients_db[client_id].owner != session["username"]:
         return jsonify({"success": False, "message": "Acesso negado! Este cliente não pertence a você!"})
-    clients_db[client_id]["status"] = "blocked" if clients_db[client_id]["status"] == "active" else "active"
-    save_db(clients_db, CLIENTS_DB_FILE)
+    client = clients_db[client_id]
+    client.status = "blocked" if client.status == "active" else "active"
+    save_db(clients_db, CLIENTS_DB_FILE, [client_id])
     return jsonify({"success": True})
 
 @app.route("/delete_client/<client_id>", methods=["POST"])
-def delete_client():
+def delete_client(client_id):
     if "username" not in session or session.get("role") not in ["admin", "simple", "master", "franchise"]:
         return jsonify({"success": False, "message": "Acesso negado!"})
     if client_id not in clients_db:
         return jsonify({"success": False, "message": "Cliente não encontrado!"})
-    if session.get("role") != "admin" and clients_db[client_id]["owner"] != session["username"]:
+    if session.get("role") != "admin" and clients_db[client_id].owner != session["username"]:
         return jsonify({"success": False, "message": "Acesso negado! Este cliente não pertence a você!"})
     
-    owner = clients_db[client_id]["owner"]
-    if owner in resellers_db:
+    owner = clients_db[client_id].owner
+    if owner in resellers_db and client_id in resellers_db[owner]["clients"]:
         resellers_db[owner]["clients"].remove(client_id)
-        save_db(resellers_db, RESELLERS_DB_FILE)
+        save_db(resellers_db, RESELLERS_DB_FILE, [owner])
     
     del clients_db[client_id]
-    save_db(clients_db, CLIENTS_DB_FILE)
+    save_db(clients_db, CLIENTS_DB_FILE, [client_id])
+    return jsonify({"success": True})
+
+@app.route("/ger_pacotes", methods=["GET", "POST"])
+def ger_pacotes():
+    if "username" not in session or session.get("role") != "admin":
+        return redirect(url_for("login"))
+    
+    if request.method == "POST":
+        package_name = request.form.get("package_name", "").strip()
+        groups = request.form.getlist("groups")
+        if not package_name or not groups:
+            flash("Informe o nome e pelo menos um grupo!")
+            return redirect(url_for("ger_pacotes"))
+        package_id = str(uuid.uuid4())
+        packages_db[package_id] = {"name": package_name, "groups": sorted(set(groups))}
+        save_db(packages_db, PACKAGES_DB_FILE, [package_id])
+        flash(f"Pacote {package_name} criado!")
+        return redirect(url_for("ger_pacotes"))
+    
+    credits = users_db.get(session["username"], {}).get("credits", float('inf'))
+    credits_display = "Infinitos" if credits == float('inf') else str(int(credits))
+    sidebar = render_template_string(sidebar_html, 
+                                   username=session["username"], 
+                                   credits=credits_display, 
+                                   role="admin", 
+                                   layout_settings=layout_settings_db)
+    rendered = current_render()
+    # Groups of packages that are no longer upstream stay listed
+    groups = set(rendered["group_bits"])
+    for package in packages_db.values():
+        groups.update(package["groups"])
+    channel_counts = {package_id: len(package_channels(rendered, package_entitlement(rendered, package_id))) for package_id in packages_db}
+    return render_template_string(ger_pacotes_html, 
+                                sidebar=sidebar,
+                                packages=dict(packages_db.items()), 
+                                groups=sorted(groups), 
+                                channel_counts=channel_counts, 
+                                credits=credits_display, 
+                                layout_settings=layout_settings_db, 
+                                username=session["username"], 
+                                role="admin")
+
+@app.route("/update_client_package/<client_id>", methods=["POST"])
+def update_client_package(client_id):
+    if "username" not in session or session.get("role") != "admin":
+        return jsonify({"success": False, "message": "Acesso negado!"})
+    if client_id not in clients_db:
+        return jsonify({"success": False, "message": "Cliente não encontrado!"})
+    package = request.form.get("package") or None
+    if package and package not in packages_db:
+        return jsonify({"success": False, "message": "Pacote inválido!"})
+    clients_db[client_id].package = package
+    save_db(clients_db, CLIENTS_DB_FILE, [client_id])
+    return jsonify({"success": True})
+
+@app.route("/update_reseller_package/<reseller_name>", methods=["POST"])
+def update_reseller_package(reseller_name):
+    if "username" not in session or session.get("role") != "admin":
+        return jsonify({"success": False, "message": "Acesso negado!"})
+    if reseller_name not in resellers_db:
+        return jsonify({"success": False, "message": "Revenda não encontrada!"})
+    package = request.form.get("package") or None
+    if package and package not in packages_db:
+        return jsonify({"success": False, "message": "Pacote inválido!"})
+    # Clients and sub-resellers without a package of their own follow it at once
+    resellers_db[reseller_name]["package"] = package
+    save_db(resellers_db, RESELLERS_DB_FILE, [reseller_name])
+    return jsonify({"success": True})
+
+@app.route("/delete_package/<package_id>", methods=["POST"])
+def delete_package(package_id):
+    if "username" not in session or session.get("role") != "admin":
+        return jsonify({"success": False, "message": "Acesso negado!"})
+    if package_id not in packages_db:
+        return jsonify({"success": False, "message": "Pacote não encontrado!"})
+    # Removing a package in use would leave its clients without channels
+    if package_users(package_id):
+        return jsonify({"success": False, "message": "Pacote em uso por clientes ou revendas!"})
+    del packages_db[package_id]
+    save_db(packages_db, PACKAGES_DB_FILE, [package_id])
     return jsonify({"success": True})
 
 @app.route("/delete_reseller/<reseller_name>", methods=["POST"])
-def delete_reseller():
+def delete_reseller(reseller_name):
     if "username" not in session or session.get("role") not in ["admin", "master", "franchise"]:
         return jsonify({"success": False, "message": "Acesso negado!"})
     if reseller_name not in resellers_db:
@@ -1012,10 +2994,14 @@ def delete_reseller():
         if resellers_db[reseller_name]["created_by"] != session["username"]:
             return jsonify({"success": False, "message": "Acesso negado! Esta revenda não foi criada por você!"})
     
+    deleted_clients = []
+    deleted_resellers = [reseller_name]
+    
     # Delete all clients of this reseller
     for client_id in resellers_db[reseller_name].get("clients", []):
         if client_id in clients_db:
             del clients_db[client_id]
+            deleted_clients.append(client_id)
     
     # Delete all sub-resellers
     for sub_reseller in resellers_db[reseller_name].get("sub_resellers", []):
@@ -1023,64 +3009,61 @@ def delete_reseller():
             for client_id in resellers_db[sub_reseller].get("clients", []):
                 if client_id in clients_db:
                     del clients_db[client_id]
+                    deleted_clients.append(client_id)
             del resellers_db[sub_reseller]
+            deleted_resellers.append(sub_reseller)
     
     # Remove from creator's sub_resellers list
     creator = resellers_db[reseller_name]["created_by"]
     if creator in resellers_db:
         resellers_db[creator]["sub_resellers"].remove(reseller_name)
+        deleted_resellers.append(creator)
     
     del resellers_db[reseller_name]
-    save_db(resellers_db, RESELLERS_DB_FILE)
-    save_db(clients_db, CLIENTS_DB_FILE)
+    save_db(resellers_db, RESELLERS_DB_FILE, deleted_resellers)
+    save_db(clients_db, CLIENTS_DB_FILE, deleted_clients)
     return jsonify({"success": True})
 
 @app.route("/get.php")
 def get_m3u():
     username = request.args.get("username")
     password = request.args.get("password")
-    output = request.args.get("output", "ts")  # Default to 'ts' for better compatibility
+    output = OUTPUT_FORMATS.get(request.args.get("output", "ts"), "original")  # Default to 'ts' for better compatibility
     if not username or not password:
         print(f"Invalid parameters: username={username}, password={password}")
         return "Parâmetros inválidos!", 400
     
-    client_id = next((cid for cid, client in clients_db.items() if client["name"] == username and client["password"] == password and client["status"] == "active"), None)
+    client_id = find_client_id(username)
+    if client_id and (clients_db[client_id].password != password or clients_db[client_id].status != "active"):
+        client_id = None
     if not client_id:
         print(f"Invalid credentials or blocked client: username={username}, password={password}")
         return "Credenciais inválidas ou cliente bloqueado!", 403
     
-    if datetime.now() > datetime.strptime(clients_db[client_id]["expiry_date"], "%Y-%m-%d"):
-        clients_db[client_id]["status"] = "expired"
-        save_db(clients_db, CLIENTS_DB_FILE)
+    if time.time() > clients_db[client_id].expires_at:
         print(f"Access expired for client: username={username}")
         return "Acesso expirado!", 403
     
-    global channels_cache
-    if not channels_cache["data"] or (channels_cache["last_updated"] and (datetime.now() - channels_cache["last_updated"]) > CACHE_TIMEOUT):
-        channels_cache["data"] = fetch_m3u(M3U_URL)
-        channels_cache["last_updated"] = datetime.now()
-    
-    if not channels_cache["data"]:
+    m3u_content, encoding, etag, identity_size = encoded_playlist(output, request.accept_encodings, client_entitlement(clients_db[client_id]))
+    if not m3u_content:
         print(f"Failed to load channels for user {username}")
         return "Erro ao carregar a playlist!", 500
     
-    m3u_content = "#EXTM3U\n"
-    grouped_channels = {}
-    for channel in channels_cache["data"]:
-        group = channel.get("group", "Outros")
-        grouped_channels.setdefault(group, []).append(channel)
-    
-    for group, channels in grouped_channels.items():
-        for channel in channels:
-            m3u_content += f'#EXTINF:-1 tvg-id="{channel["tvg_id"]}" tvg-name="{channel["name"]}" tvg-logo="{channel["logo"]}" group-title="{group}",{channel["title"]}\n'
-            m3u_content += f"{channel['url']}\n"
-    
-    print(f"Generated M3U with {len(channels_cache['data'])} channels for user {username}")
-    response = Response(m3u_content, mimetype="application/x-mpegURL")
-    response.headers["Content-Disposition"] = "attachment; filename=playlist.m3u"
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
+    if etag and request.if_none_match.contains_weak(etag):
+        print(f"Playlist not modified for user {username}")
+        response = Response(status=304)
+    else:
+        print(f"Serving M3U ({len(m3u_content)} bytes, {encoding or 'identity'}) for user {username}")
+        response = Response(iter_chunks(m3u_content) if PLAYLIST_STREAMING else m3u_content, mimetype="application/x-mpegURL")
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+            compression_stats["bytes_saved"] += identity_size - len(m3u_content)
+        response.headers["Content-Disposition"] = "attachment; filename=playlist.m3u"
+    if etag:
+        response.set_etag(etag)
+    response.headers["Vary"] = "Accept-Encoding"
+    # Players may keep the playlist but must revalidate it (auth runs on every request)
+    response.headers["Cache-Control"] = "private, no-cache"
     return response
 
 @app.route("/player_api.php")
@@ -1093,25 +3076,22 @@ def player_api():
         print(f"Missing username or password: username={username}, password={password}")
         return jsonify({"user_info": {"auth": 0}, "message": "Credenciais ausentes", "status": "error"}), 401
     
-    client_id = next((cid for cid, client in clients_db.items() if client["name"] == username and client["password"] == password), None)
+    client_id = find_client_id(username)
+    if client_id and clients_db[client_id].password != password:
+        client_id = None
     if not client_id:
         print(f"Invalid credentials for player_api: username={username}, password={password}")
         return jsonify({"user_info": {"auth": 0}, "message": "Credenciais inválidas", "status": "error"}), 401
     
     client = clients_db[client_id]
-    if client["status"] != "active":
-        print(f"Client not active: username={username}, status={client['status']}")
+    if client.status != "active":
+        print(f"Client not active: username={username}, status={client.status}")
         return jsonify({"user_info": {"auth": 0}, "message": "Cliente bloqueado ou expirado", "status": "error"}), 401
     
-    expiry_date = datetime.strptime(client["expiry_date"], "%Y-%m-%d")
-    if datetime.now() > expiry_date:
-        client["status"] = "expired"
-        save_db(clients_db, CLIENTS_DB_FILE)
-        print(f"Client expired: username={username}, expiry_date={client['expiry_date']}")
+    if time.time() > client.expires_at:
+        print(f"Client expired: username={username}, expiry_date={client.expiry_date}")
         return jsonify({"user_info": {"auth": 0}, "message": "Acesso expirado", "status": "error"}), 401
     
-    expiry_timestamp = int(expiry_date.timestamp())
-    
     # Default response for missing or invalid action
     user_info = {
         "user_info": {
@@ -1120,11 +3100,11 @@ def player_api():
             "message": "Login successful",
             "auth": 1,
             "status": "Active",
-            "exp_date": expiry_timestamp,
+            "exp_date": client.expires_at,
             "is_trial": 0,
             "active_cons": 0,
             "created_at": int(datetime.now().timestamp()),
-            "max_connections": client["connections"],
+            "max_connections": client.connections,
             "allowed_output_formats": ["ts", "m3u8"]
         },
         "server_info": {
@@ -1148,45 +3128,41 @@ def player_api():
         ])
     
     elif action == "get_live_streams":
-        global channels_cache
-        if not channels_cache["data"] or (channels_cache["last_updated"] and (datetime.now() - channels_cache["last_updated"]) > CACHE_TIMEOUT):
-            channels_cache["data"] = fetch_m3u(M3U_URL)
-            channels_cache["last_updated"] = datetime.now()
-        
-        if not channels_cache["data"]:
+        streams = live_streams_json(client_entitlement(client))
+        if not streams:
             print(f"Failed to load channels for user {username}")
             return jsonify({"message": "Erro ao carregar canais", "status": "error"}), 500
         
-        streams = []
-        for channel in channels_cache["data"]:
-            streams.append({
-                "stream_id": channel["tvg_id"],
-                "name": channel["name"],
-                "logo": channel["logo"],
-                "epg_channel_id": channel["tvg_id"],
-                "category_id": "1" if channel["group"] != "Outros" else "2",
-                "stream_type": "live",
-                "stream_url": channel["url"],
-                "added": str(int(datetime.now().timestamp())),
-                "is_adult": 0
-            })
-        print(f"Returning {len(streams)} live streams for username={username}")
-        return jsonify(streams)
+        print(f"Returning live streams ({len(streams)} bytes) for username={username}")
+        return Response(streams, mimetype="application/json")
     
     # Fallback for missing or invalid action
     print(f"Invalid or missing action for username={username}, action={action}")
     return jsonify(user_info)
 
+XMLTV_CONTENT = b'<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE tv SYSTEM "xmltv.dtd">\n<tv></tv>'
+
 @app.route("/xmltv.php")
 def xmltv():
     username = request.args.get("username")
     password = request.args.get("password")
-    client_id = next((cid for cid, client in clients_db.items() if client["name"] == username and client["password"] == password), None)
+    client_id = find_client_id(username)
+    if client_id and clients_db[client_id].password != password:
+        client_id = None
     if not client_id:
         print(f"Invalid credentials for xmltv: username={username}")
         return "Credenciais inválidas", 401
-    xmltv_content = '<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE tv SYSTEM "xmltv.dtd">\n<tv></tv>'
-    return Response(xmltv_content, mimetype="application/xml", headers={"Content-Disposition": "attachment; filename=epg.xml"})
+    if time.time() > clients_db[client_id].expires_at:
+        print(f"Access expired for xmltv: username={username}")
+        return "Acesso expirado", 403
+    etag = f"xmltv-{hashlib.blake2b(XMLTV_CONTENT, digest_size=12).hexdigest()}"
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(XMLTV_CONTENT, mimetype="application/xml", headers={"Content-Disposition": "attachment; filename=epg.xml"})
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
 
 if __name__ == "__main__":
     # Ensure admin exists in resellers_db for sub-resellers
@@ -1201,9 +3177,9 @@ if __name__ == "__main__":
             "sub_resellers": [],
             "role": "admin"
         }
-        save_db(resellers_db, RESELLERS_DB_FILE)
+        save_db(resellers_db, RESELLERS_DB_FILE, ["admin"])
     
-    channels_cache["data"] = fetch_m3u(M3U_URL)
-    channels_cache["last_updated"] = datetime.now()
-    print(f"Total de canais encontrados: {len(channels_cache['data'])}")
+    # Serve the snapshot (if any) right away; the first request waits only when there is none
+    threading.Thread(target=refresh_channels, daemon=True).start()
+    print(f"Canais carregados do snapshot: {len(channels_cache['data'])}")
     app.run(debug=True, host="0.0.0.0", port=5000)
\ No newline at end of file
@@ -0,0 +1,115 @@
+"""Stream prober against a local stand-in server.
+
+    python -m unittest test_prober
+
+The panel is imported inside a temporary directory so the real *_db.json
+files are never touched.
+"""
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="painel-test-"))
+os.environ.setdefault("PAINEL_FLUSH_INTERVAL", "0")
+os.environ["PAINEL_PROBE_INTERVAL"] = "0"
+
+import painel
+
+
+class StreamServer(ThreadingHTTPServer):
+    """Answers 200 for every stream whose id is not in self.down, 404 for the rest."""
+
+    def __init__(self):
+        self.down = set()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(handler):
+                stream_id = handler.path.rsplit("/", 1)[-1].split(".")[0]
+                handler.send_response(404 if stream_id in self.down else 200)
+                handler.send_header("Content-Length", "0")
+                handler.end_headers()
+
+            do_GET = do_HEAD
+
+            def log_message(handler, *args):
+                pass
+
+        super().__init__(("127.0.0.1", 0), Handler)
+
+
+class ProberTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StreamServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{self.server.server_address[1]}/live/u/p"
+        lines = []
+        for i in range(1, 5):
+            lines += [f'#EXTINF:-1 tvg-id="ch{i}" group-title="Grupo",Canal {i}', f"{base}/{i}.ts"]
+        painel.channels_cache["data"] = list(painel.parse_m3u(lines))
+        painel.channels_cache["last_updated"] = painel.datetime.now()
+        painel.channels_cache["last_attempt"] = painel.datetime.now()
+        painel.channels_cache["generation"] += 1
+        painel.channel_health.clear()
+        painel.set_dead_urls(frozenset())
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        painel.channels_cache["data"] = []
+        painel.channel_health.clear()
+        painel.set_dead_urls(frozenset())
+
+    def served(self) -> list:
+        return [channel.name for channel in painel.live_channels()]
+
+    def playlist_urls(self) -> list:
+        return [line for line in painel.playlist_bytes("original").decode().splitlines() if line.startswith("http")]
+
+    def test_failing_stream_is_hidden_after_dead_after_rounds(self):
+        self.server.down.add("2")
+        for _ in range(painel.PROBE_DEAD_AFTER - 1):
+            painel.probe_channels()
+            self.assertIn("Canal 2", self.served())
+        painel.probe_channels()
+        self.assertEqual(self.served(), ["Canal 1", "Canal 3", "Canal 4"])
+        self.assertFalse(any(url.endswith("/2.ts") for url in self.playlist_urls()))
+
+    def test_recovered_stream_is_restored(self):
+        self.server.down.add("3")
+        for _ in range(painel.PROBE_DEAD_AFTER):
+            painel.probe_channels()
+        self.assertNotIn("Canal 3", self.served())
+        generation = painel.channels_cache["generation"]
+        self.server.down.clear()
+        painel.probe_channels()
+        self.assertEqual(self.served(), ["Canal 1", "Canal 2", "Canal 3", "Canal 4"])
+        self.assertGreater(painel.channels_cache["generation"], generation)
+        self.assertTrue(any(url.endswith("/3.ts") for url in self.playlist_urls()))
+
+    def test_followers_take_the_probers_dead_urls(self):
+        self.server.down.add("4")
+        for _ in range(painel.PROBE_DEAD_AFTER):
+            painel.probe_channels()
+        hidden = painel.dead_urls
+        # Another worker on the host: nothing probed, only the shared file
+        painel.set_dead_urls(frozenset())
+        painel.dead_urls_digest = None
+        painel.load_dead_urls()
+        self.assertEqual(painel.dead_urls, hidden)
+        self.assertNotIn("Canal 4", self.served())
+        # The prober writes again once the stream is back
+        self.server.down.clear()
+        painel.probe_channels()
+        painel.set_dead_urls(hidden)
+        painel.load_dead_urls()
+        self.assertEqual(painel.dead_urls, frozenset())
+
+
+if __name__ == "__main__":
+    unittest.main()